@@ -0,0 +1,132 @@
+""":mod:`okydoky.access` --- Authorization cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Whether a user can read the repository is checked by a single request to
+the repository API with the user's access token.  Results are cached
+server-wide for each token: stale results are served while they're
+refreshed in the background, and concurrent checks for the same token share
+a single request.
+
+Only answers which say the user can't see the repository are cached.
+Other errors, e.g., the exhausted rate limit, aren't, so stale positive
+results keep being served meanwhile.
+
+"""
+import hashlib
+import logging
+import time
+
+from eventlet import spawn_n
+from eventlet.event import Event
+
+from .github import HTTPError, client
+
+
+class InvalidToken(Exception):
+    """Raised when GitHub rejects the access token of the user, e.g.,
+    because it has been revoked.  The user has to log in again.
+
+    """
+
+
+def check_access(token, url):
+    """Checks whether the user of ``token`` can read the repository of
+    the API ``url``.  GitHub answers 404 for private repositories the user
+    can't see.
+
+    :raises InvalidToken: when GitHub rejects the ``token``
+    :raises okydoky.github.HTTPError: when GitHub fails to answer, e.g.,
+                                      because of its rate limit
+
+    """
+    try:
+        response = client.request('GET', url, token=token)
+    except HTTPError as e:
+        if e.code == 401:
+            raise InvalidToken(str(e))
+        elif e.code == 404 or e.code == 403 and not e.is_rate_limited():
+            return False
+        raise
+    repo = response.json()
+    return bool(repo.get('permissions', {}).get('pull'))
+
+
+class AccessCache(object):
+    """The server-wide cache of authorization results.
+
+    :param check: the function which takes a token and the API URL of
+                  a repository and returns whether it's accessible
+    :param ttl: the seconds during which results are fresh
+    :param stale_ttl: the seconds during which positive results can be
+                      served while they're refreshed in the background
+
+    """
+
+    #: (:class:`int`) The number of entries over which expired entries
+    #: are pruned.
+    max_entries = 1024
+
+    def __init__(self, check, ttl, stale_ttl):
+        self.check = check
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = {}
+        self.pending = {}
+
+    def get(self, token, repository):
+        """Tests whether the user of ``token`` can read the ``repository``.
+        It blocks only if there's no usable cached result.
+
+        """
+        key = hashlib.sha1(repository + '\0' + token).hexdigest()
+        try:
+            allowed, checked_at = self.entries[key]
+        except KeyError:
+            pass
+        else:
+            age = time.time() - checked_at
+            if age < self.ttl:
+                return allowed
+            elif allowed and age < self.stale_ttl:
+                self.refresh(key, token, repository)
+                return allowed
+        return self.refresh(key, token, repository).wait()
+
+    def refresh(self, key, token, repository):
+        """Starts checking the access unless it's already being checked.
+        Returns the :class:`~eventlet.event.Event` of the check.
+
+        """
+        try:
+            return self.pending[key]
+        except KeyError:
+            event = self.pending[key] = Event()
+            spawn_n(self._check, key, token, repository, event)
+            return event
+
+    def _check(self, key, token, repository, event):
+        logger = logging.getLogger(__name__ + '.AccessCache._check')
+        try:
+            allowed = self.check(token, repository)
+        except InvalidToken as e:
+            logger.info('the token was rejected: %s', e)
+            self.entries.pop(key, None)
+            event.send_exception(e)
+        except Exception as e:
+            logger.exception('failed to check the access to %s', repository)
+            event.send_exception(e)
+        else:
+            logger.debug('access to %s: %r', repository, allowed)
+            self.entries[key] = allowed, time.time()
+            event.send(allowed)
+        finally:
+            del self.pending[key]
+        if len(self.entries) > self.max_entries:
+            self.prune()
+
+    def prune(self):
+        """Removes expired entries."""
+        expired = time.time() - max(self.ttl, self.stale_ttl)
+        for key, (_, checked_at) in self.entries.items():
+            if checked_at < expired:
+                del self.entries[key]
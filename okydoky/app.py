@@ -3,63 +3,280 @@
 
 """
 import base64
+import collections
+import contextlib
 import datetime
-import functools
+import errno
+import fnmatch
 import hashlib
 import hmac
 import logging
+import mimetypes
+import multiprocessing
 import os
 import os.path
-import pkg_resources
 import re
 import shutil
-import subprocess
 import sys
 import tarfile
+import tempfile
 import time
+import traceback
 
-from eventlet import spawn_n
-from eventlet.green import urllib2
-from eventlet.greenpool import GreenPool
-from flask import (Flask, abort, current_app, json, make_response, redirect,
-                   request, render_template, session, url_for)
-from flask.helpers import send_from_directory
+from eventlet import sleep, spawn, spawn_n, tpool
+from eventlet.green import subprocess
+from eventlet.greenio import GreenPipe
+from eventlet.queue import Empty, LightQueue
+from eventlet.semaphore import Semaphore
+from flask import (Flask, abort, current_app, g, json, jsonify,
+                   make_response, redirect, request, render_template, session,
+                   url_for)
+from flask.helpers import safe_join, send_from_directory
 from iso8601 import parse_date
-from virtualenv import create_environment, virtualenv_version
 from werkzeug.urls import url_decode, url_encode
 
+from .access import AccessCache, InvalidToken, check_access
+from .buildindex import BuildIndex
+from .buildlog import get_log_path, open_log, tail
+from .buildqueue import HEARTBEAT_INTERVAL, BuildQueue
+from .cluster import FileLock
+from .compress import ENCODINGS, compress_build, is_compressible
+from .envpool import (SPHINX_REQUIREMENT, VirtualenvPool, create_virtualenv,
+                      get_env_key, link_sphinx_env)
+from .github import client as github, get_api_url, get_url
+from .hosting import (CONFIG_ENVIRON_KEY, SCRIPT_ROOT_ENVIRON_KEY,
+                      get_root_config, make_configs)
+from .metrics import (ARCHIVE_BYTES, BUILD_LATENCY_SECONDS, BUILDS_RUNNING,
+                      BUILDS_TOTAL, DEDUP_SAVED_BYTES, QUEUE_DEPTH,
+                      REQUEST_SECONDS, CountingReader, add_labels,
+                      read_snapshot, registry, render, timed)
+from .pipeline import Pipeline
+from .retention import get_disk_usage, get_tagged_commits, sweep
+from .sandbox import BuildAborted, BuildCancelled, Sandbox
+from .search import SearchIndex
+from .incremental import (get_cache_key, get_fingerprint, lease_work_dir,
+                          restore_cache, store_cache)
+from .pack import PACK_SUFFIX, Pack
+from .packagecache import PackageCache
+from .store import clone, is_published, publish, read_manifest
+
 
 REQUIRED_CONFIGS = ('REPOSITORY', 'CLIENT_ID', 'CLIENT_SECRET',
                     'SAVE_DIRECTORY', 'SECRET_KEY')
 EXPIRES = datetime.timedelta(minutes=5)
+STALE_EXPIRES = datetime.timedelta(hours=1)
+
+#: (:class:`tuple`) The available values of ``BUILD_POLICY`` config.
+BUILD_POLICIES = 'latest', 'all', 'every-nth'
+
+#: (:class:`int`) The seconds idle build workers wait for new jobs before
+#: looking into the queue again.  Jobs enqueued by other processes are
+#: noticed at this interval.
+QUEUE_POLL_INTERVAL = 1
+
+#: (:class:`dict`) The :class:`~okydoky.buildqueue.BuildQueue` for each
+#: ``SAVE_DIRECTORY``.
+build_queues = {}
+
+#: (:class:`dict`) The channel to wake up build workers running in this
+#: process, for each ``SAVE_DIRECTORY``.
+workers = {}
+
+#: (:class:`int`) The number of builds to list in a page.
+BUILDS_PER_PAGE = 50
+
+#: (:class:`dict`) The :class:`~okydoky.buildindex.BuildIndex` for each
+#: ``SAVE_DIRECTORY``.
+build_indices = {}
+
+#: (:class:`~okydoky.access.AccessCache`) The server-wide cache of
+#: authorization results.
+access_cache = AccessCache(check_access, EXPIRES.total_seconds(),
+                           STALE_EXPIRES.total_seconds())
+
+#: (:class:`dict`) The :class:`~okydoky.envpool.VirtualenvPool` for each
+#: ``SAVE_DIRECTORY``.
+env_pools = {}
+
+#: (:class:`int`) The seconds browsers can cache docs of full SHA URLs.
+#: They never change once built.
+IMMUTABLE_CACHE_TIMEOUT = 365 * 24 * 60 * 60
+
+#: (:class:`int`) The seconds browsers can cache docs of ``/head/`` and
+#: redirections from short refs.
+HEAD_CACHE_TIMEOUT = 60
+
+#: (:class:`int`) The number of manifests of published docs to keep
+#: in memory.
+MANIFEST_CACHE_SIZE = 64
+
+#: (:class:`collections.OrderedDict`) The LRU cache of manifests of
+#: published docs.
+manifests = collections.OrderedDict()
+
+#: (:class:`int`) The number of packs to keep mapped.
+PACK_CACHE_SIZE = 16
+
+#: (:class:`collections.OrderedDict`) The LRU cache of
+#: :class:`~okydoky.pack.Pack` objects.
+packs = collections.OrderedDict()
+
+#: (:class:`dict`) The channel to trigger the retention sweeper running in
+#: this process, for each ``SAVE_DIRECTORY``.
+sweepers = {}
+
+#: (:class:`int`) The seconds accesses to the same build are recorded at
+#: most once in.
+ACCESS_RECORD_INTERVAL = 60 * 60
+
+#: (:class:`dict`) The last times accesses to builds were recorded.
+accesses = {}
+
+#: (:class:`dict`) The :class:`~okydoky.search.SearchIndex` for each
+#: ``SAVE_DIRECTORY``.
+search_indices = {}
+
+#: (:class:`int`) The maximum number of search results.
+SEARCH_RESULTS = 20
+
+#: (:class:`int`) The seconds ``head.txt`` and ``token.txt`` are checked
+#: for changes at most once in.
+HEAD_CHECK_INTERVAL = 1
+
+#: (:class:`dict`) The triple of the head, the version of ``head.txt`` and
+#: the time it was checked for each ``SAVE_DIRECTORY``.
+heads = {}
+
+#: (:class:`dict`) The triple of the access token, the version of
+#: ``token.txt`` and the time it was checked for each root
+#: ``SAVE_DIRECTORY``.
+tokens = {}
+
+#: (:class:`dict`) The :class:`~okydoky.hosting.RepositoryConfig` of
+#: ``REPOSITORIES`` for each ``SAVE_DIRECTORY``.
+repository_configs = {}
 
 app = Flask(__name__)
 
 
+def get_config():
+    """The config of the repository which the current request is for.
+    It's the app's config unless ``REPOSITORIES`` is set.
+
+    """
+    return request.environ.get(CONFIG_ENVIRON_KEY) or current_app.config
+
+
+def get_repository_configs(config):
+    """The list of configs of repositories hosted by the ``config``.
+    It's a list of the ``config`` itself unless ``REPOSITORIES`` is set.
+
+    """
+    if not config.get('REPOSITORIES'):
+        return [config]
+    save_dir = config['SAVE_DIRECTORY']
+    try:
+        configs = repository_configs[save_dir]
+    except KeyError:
+        configs = repository_configs[save_dir] = make_configs(config)
+    return configs.values()
+
+
+@app.context_processor
+def inject_config():
+    return {'config': get_config()}
+
+
 def open_file(filename, mode='r', config=None):
-    config = config or current_app.config
+    config = config or get_config()
     save_path = config['SAVE_DIRECTORY']
     if not os.path.isdir(save_path):
         os.makedirs(save_path)
     return open(os.path.join(save_path, filename), mode)
 
 
+def replace_file(filename, content, config=None):
+    """Replaces the file under the ``SAVE_DIRECTORY`` with the ``content``
+    atomically, so that readers, even on other nodes, never see
+    a half-written file.
+
+    """
+    config = config or get_config()
+    save_dir = config['SAVE_DIRECTORY']
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    fd, tmp = tempfile.mkstemp(prefix='.', dir=save_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.rename(tmp, os.path.join(save_dir, filename))
+
+
 def open_token_file(mode='r', config=None):
+    # The access token is shared by all hosted repositories.
+    config = get_root_config(config or get_config())
     return open_file('token.txt', mode, config=config)
 
 
 def get_token(config=None):
-    config = config or current_app.config
+    """The access token.  Unless ``ACCESS_TOKEN`` is configured, it's read
+    from ``token.txt``, which is read again if it has been replaced, e.g.,
+    by the web server after the re-authorization.
+
+    """
+    config = get_root_config(config or get_config())
+    if 'ACCESS_TOKEN' in config:
+        return config['ACCESS_TOKEN']
+    return read_replaced_file(tokens, 'token.txt', config)
+
+
+def get_build_index(config=None):
+    config = config or get_config()
+    save_dir = config['SAVE_DIRECTORY']
     try:
-        token = config['ACCESS_TOKEN']
+        return build_indices[save_dir]
     except KeyError:
-        try:
-            with open_token_file(config=config) as f:
-                token = f.read().strip()
-        except IOError:
-            return None
-        config['ACCESS_TOKEN'] = token
-    return token
+        index = build_indices[save_dir] = BuildIndex(config)
+        return index
+
+
+def get_build_queue(config=None):
+    config = config or get_config()
+    save_dir = config['SAVE_DIRECTORY']
+    try:
+        return build_queues[save_dir]
+    except KeyError:
+        queue = build_queues[save_dir] = BuildQueue(config)
+        return queue
+
+
+def get_search_index(config=None):
+    config = config or get_config()
+    save_dir = config['SAVE_DIRECTORY']
+    try:
+        return search_indices[save_dir]
+    except KeyError:
+        index = search_indices[save_dir] = SearchIndex(config)
+        return index
+
+
+def get_package_cache(config):
+    """The :class:`~okydoky.packagecache.PackageCache`, or ``None`` if
+    ``PACKAGE_CACHE`` is turned off.
+
+    """
+    if config.get('PACKAGE_CACHE', True):
+        return PackageCache(config)
+
+
+def get_env_pool(config):
+    # Virtualenvs are shared by all hosted repositories.
+    config = get_root_config(config)
+    save_dir = config['SAVE_DIRECTORY']
+    try:
+        return env_pools[save_dir]
+    except KeyError:
+        pool = env_pools[save_dir] = VirtualenvPool(config)
+        return pool
 
 
 def open_head_file(mode='r', config=None):
@@ -67,11 +284,48 @@ def open_head_file(mode='r', config=None):
 
 
 def get_head(config=None):
+    """The current head.  It's kept in memory, and ``head.txt`` is read
+    again only if it has been replaced.
+
+    """
+    return read_replaced_file(heads, 'head.txt', config or get_config())
+
+
+def read_replaced_file(cache, filename, config):
+    """Reads the file under the ``SAVE_DIRECTORY`` which is updated by
+    :func:`replace_file()`.  Its content is kept in the ``cache``, and
+    the file is read again only if it has been replaced, which is checked
+    at most once every :const:`HEAD_CHECK_INTERVAL` seconds.  Returns
+    ``None`` if there's no such file.
+
+    """
+    save_dir = config['SAVE_DIRECTORY']
+    now = time.time()
+    content, version, checked_at = cache.get(save_dir, (None, None, 0))
+    if now - checked_at < HEAD_CHECK_INTERVAL:
+        return content
     try:
-        with open_head_file(config=config) as f:
-            return f.read().strip()
-    except IOError:
-        pass
+        stat = os.stat(os.path.join(save_dir, filename))
+    except OSError:
+        content = version = None
+    else:
+        # The file is replaced by rename(), so the inode changes as well.
+        if (stat.st_ino, stat.st_mtime) != version:
+            version = stat.st_ino, stat.st_mtime
+            try:
+                with open_file(filename, config=config) as f:
+                    content = f.read().strip()
+            except IOError:
+                content = version = None
+    cache[save_dir] = content, version, now
+    return content
+
+
+def set_head(commit, config=None):
+    """Replaces ``head.txt`` with the ``commit`` atomically."""
+    config = config or get_config()
+    replace_file('head.txt', commit, config)
+    heads.pop(config['SAVE_DIRECTORY'], None)
 
 
 def ensure_login():
@@ -79,54 +333,87 @@ def ensure_login():
     try:
         login = session['login']
     except KeyError:
-        session.pop('access', None)
-        back = base64.urlsafe_b64encode(request.url)
-        params = {
-            'client_id': current_app.config['CLIENT_ID'],
-            'redirect_uri': url_for('auth', back=back, _external=True),
-            'scope': 'repo'
-        }
-        return redirect('https://github.com/login/oauth/authorize?' +
-                        url_encode(params))
+        return redirect_to_login()
     logger.debug('login = %r', login)
+    config = get_config()
+    if not config.get('REPOSITORY'):
+        # The root of hosted repositories; each of them is checked.
+        return
     try:
-        auth, ltime = session['access']
-    except (KeyError, ValueError):
-        auth = False
-        ltime = None
-    if ltime is None or ltime < datetime.datetime.utcnow() - EXPIRES:
-        repo_name = current_app.config['REPOSITORY']
-        # user repos
-        response = urllib2.urlopen(
-            'https://api.github.com/user/repos?per_page=100&access_token=' +
-            login
+        auth = access_cache.get(
+            login, get_api_url('/repos/' + config['REPOSITORY'], config)
         )
-        repo_dicts = json.load(response)
-        response.close()
-        repos = frozenset(repo['full_name'] for repo in repo_dicts)
-        logger.debug('repos = %r', repos)
-        auth = repo_name in repos
-        # org repos
-        if not auth:
-            url = 'https://api.github.com/orgs/{0}/repos?per_page=100&access_token={1}'
-            try:
-                response = urllib2.urlopen(
-                    url.format(repo_name.split('/', 1)[0], login)
-                )
-            except IOError:
-                auth = False
-            else:
-                repo_dicts = json.load(response)
-                response.close()
-                org_repos = frozenset(repo['full_name'] for repo in repo_dicts)
-                logger.debug('org_repos = %r', org_repos)
-                auth = repo_name in org_repos
-        session['access'] = auth, datetime.datetime.utcnow()
+    except InvalidToken:
+        logger.info('the login token was rejected; log in again')
+        del session['login']
+        return redirect_to_login()
     if not auth:
         abort(403)
     logger.debug('auth = %r', auth)
 
 
+def redirect_to_login():
+    """Redirects the user to the GitHub OAuth authorization, which comes
+    back to the current URL.
+
+    """
+    back = base64.urlsafe_b64encode(request.url)
+    params = {
+        'client_id': get_config()['CLIENT_ID'],
+        'redirect_uri': get_auth_url(back=back),
+        'scope': 'repo'
+    }
+    return redirect(get_url('/login/oauth/authorize?', get_config()) +
+                    url_encode(params))
+
+
+def get_auth_url(**values):
+    """Builds the URL of the OAuth callback.  It's always at the root,
+    even if the repository is hosted under ``/<owner>/<repo>/``.
+
+    """
+    script_root = request.environ.get(SCRIPT_ROOT_ENVIRON_KEY,
+                                      request.script_root)
+    adapter = current_app.url_map.bind(request.host, script_root,
+                                       url_scheme=request.scheme)
+    return adapter.build('auth', values, force_external=True)
+
+
+@app.before_request
+def start_timer():
+    g.started_at = time.time()
+
+
+@app.after_request
+def observe_latency(response):
+    started_at = getattr(g, 'started_at', None)
+    if started_at is not None and request.endpoint != 'metrics':
+        REQUEST_SECONDS.observe(time.time() - started_at,
+                                endpoint=request.endpoint or 'none')
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Exposes metrics of the web server and the build worker in
+    the Prometheus text format.  If ``METRICS_TOKEN`` is set, it has to be
+    sent as the bearer token.
+
+    """
+    token = get_config().get('METRICS_TOKEN')
+    if (token is not None and
+            request.headers.get('Authorization') != 'Bearer ' + token):
+        abort(401)
+    config = get_root_config(get_config())
+    QUEUE_DEPTH.set(sum(len(get_build_queue(c).pending())
+                        for c in get_repository_configs(config)))
+    families = (add_labels(registry.collect(), process='web') +
+                add_labels(read_snapshot(config), process='worker'))
+    response = make_response(render(families))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
+
 @app.route('/')
 def home():
     token = get_token()
@@ -135,46 +422,309 @@ def home():
     redirect = ensure_login()
     if redirect:
         return redirect
+    config = get_config()
+    if not config.get('REPOSITORY'):
+        return list_repositories(config)
     head = get_head()
     if head is None:
         hook_url = url_for('post_receive_hook', _external=True)
         return render_template('empty.html', hook_url=hook_url)
-    save_dir = current_app.config['SAVE_DIRECTORY']
-    refs = {}
-    time_fmt = '%Y-%m-%dT%H:%M:%SZ'
-    build_logs = {}
-    for name in os.listdir(save_dir):
-        if re.match(r'^[A-Fa-f0-9]{40}$', name):
-            fullname = os.path.join(save_dir, name)
-            stat = os.stat(fullname)
-            refs[name] = time.strftime(time_fmt, time.gmtime(stat.st_mtime))
-            build_logs[name] = os.path.isfile(
-                os.path.join(fullname, 'build.txt')
-            )
-    return render_template('list.html',
-                           head=head, refs=refs, build_logs=build_logs)
+    index = get_build_index()
+    pages = max(1, -(-index.count() // BUILDS_PER_PAGE))
+    page = min(max(1, request.args.get('page', 1, type=int)), pages)
+    builds = index.list((page - 1) * BUILDS_PER_PAGE, BUILDS_PER_PAGE)
+    running = get_build_queue().running() if page == 1 else []
+    return render_template('list.html', head=head, head_build=index.get(head),
+                           builds=builds, running=running, page=page,
+                           pages=pages)
+
+
+def list_repositories(config):
+    """Lists hosted repositories which the user can access."""
+    login = session['login']
+    try:
+        repositories = [
+            c['REPOSITORY'] for c in get_repository_configs(config)
+            if access_cache.get(login,
+                                get_api_url('/repos/' + c['REPOSITORY'], c))
+        ]
+    except InvalidToken:
+        del session['login']
+        return redirect_to_login()
+    return render_template('repositories.html', repositories=repositories)
+
+
+@app.route('/builds.json')
+def builds_json():
+    redirect = ensure_login()
+    if redirect:
+        return redirect
+    index = get_build_index()
+    total = index.count()
+    page = max(1, request.args.get('page', 1, type=int))
+    builds = index.list((page - 1) * BUILDS_PER_PAGE, BUILDS_PER_PAGE)
+    return jsonify(head=get_head(), builds=builds, page=page,
+                   pages=-(-total // BUILDS_PER_PAGE), total=total)
+
+
+@app.route('/<ref>/_search')
+def search(ref):
+    """Searches the docs of ``ref`` for the query ``q``, and returns
+    the results in JSON.  Results can be cached for a long time only if
+    the build has been indexed.
+
+    """
+    immutable = True
+    if ref == 'head':
+        ref = get_head()
+        if ref is None:
+            abort(404)
+        immutable = False
+    elif not re.match(r'^[A-Fa-f0-9]{7,40}$', ref):
+        abort(404)
+    login_redirect = ensure_login()
+    if login_redirect:
+        return login_redirect
+    if len(ref) < 40:
+        ref = get_build_index().resolve(ref)
+        if ref is None:
+            abort(404)
+        immutable = False
+    build = get_build_index().get(ref)
+    if build is None or build['status'] != 'success':
+        abort(404)
+    search_index = get_search_index()
+    if not search_index.is_indexed(ref):
+        immutable = False
+    query = request.args.get('q', '')
+    results = search_index.search(ref, query, SEARCH_RESULTS)
+    for result in results:
+        result['url'] = url_for('docs', ref=ref, path=result['path'])
+    response = jsonify(sha=ref, query=query, results=results)
+    if immutable:
+        set_cache_control(response, IMMUTABLE_CACHE_TIMEOUT, immutable=True)
+    else:
+        set_cache_control(response, HEAD_CACHE_TIMEOUT)
+    return response
+
+
+@app.route('/<ref>/_log')
+def build_log(ref):
+    """Sends the log of the build of ``ref``.  If it's being built,
+    output is streamed until the build finishes.
+
+    """
+    if not re.match(r'^[A-Fa-f0-9]{40}$', ref):
+        abort(404)
+    login_redirect = ensure_login()
+    if login_redirect:
+        return login_redirect
+    filename = get_log_path(ref, get_config())
+    if not os.path.isfile(filename):
+        abort(404)
+    queue = get_build_queue()
+    response = current_app.response_class(
+        tail(filename, lambda: queue.is_running(ref)),
+        mimetype='text/plain'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    # Let browsers render it progressively, and proxies not buffer it.
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/<ref>/_cancel', methods=['POST'])
+def cancel_build(ref):
+    """Cancels the queued or running build of ``ref``.  ``ADMIN_TOKEN``
+    has to be sent as the bearer token.
+
+    """
+    token = get_config().get('ADMIN_TOKEN')
+    if token is None:
+        abort(403)
+    elif request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(401)
+    elif not re.match(r'^[A-Fa-f0-9]{40}$', ref):
+        abort(404)
+    state = get_build_queue().cancel(ref.lower())
+    if state is None:
+        abort(404)
+    return jsonify(commit=ref.lower(), state=state)
 
 
 @app.route('/<ref>/', defaults={'path': 'index.html'})
 @app.route('/<ref>/<path:path>')
 def docs(ref, path):
+    immutable = True
     if ref == 'head':
         ref = get_head()
         if ref is None:
             abort(404)
+        immutable = False
     elif not re.match(r'^[A-Fa-f0-9]{7,40}$', ref):
         abort(404)
-    redirect = ensure_login()
-    if redirect:
-        return redirect
-    save_dir = current_app.config['SAVE_DIRECTORY']
+    login_redirect = ensure_login()
+    if login_redirect:
+        return login_redirect
+    save_dir = get_config()['SAVE_DIRECTORY']
     if len(ref) < 40:
-        for candi in os.listdir(save_dir):
-            if (os.path.isdir(os.path.join(save_dir, candi)) and
-                candi.startswith(ref)):
-                return redirect(url_for('docs', ref=candi, path=path))
+        sha = get_build_index().resolve(ref)
+        if sha is None:
+            abort(404)
+        response = redirect(url_for('docs', ref=sha, path=path))
+        set_cache_control(response, HEAD_CACHE_TIMEOUT)
+        return response
+    if get_config().get('RETAIN_BUILDS') is not None:
+        record_access(save_dir, ref)
+    if get_config().get('STORAGE_FORMAT', 'directory') == 'pack':
+        pack = get_pack(save_dir, ref)
+        if pack is not None:
+            return send_packed_docs(pack, path, immutable)
+    return send_docs(save_dir, ref, path, immutable)
+
+
+def record_access(save_dir, sha):
+    """Records the access to the build of ``sha`` for the retention, at
+    most once in :const:`ACCESS_RECORD_INTERVAL`.
+
+    """
+    now = time.time()
+    key = save_dir, sha
+    if accesses.get(key, 0) + ACCESS_RECORD_INTERVAL < now:
+        accesses[key] = now
+        get_build_index().touch(sha, now)
+
+
+def send_docs(save_dir, ref, path, immutable=True):
+    """Sends the file of built docs.  If the client accepts, its
+    precompressed sibling is sent instead.  The response has the strong
+    ETag of its content, and it can be cached for a long time if it's
+    ``immutable``.
+
+    """
+    filename = os.path.join(ref, path)
+    sent = filename
+    headers = {}
+    if is_compressible(filename):
+        headers['Vary'] = 'Accept-Encoding'
+        for encoding, suffix in ENCODINGS:
+            if not request.accept_encodings[encoding]:
+                continue
+            compressed = safe_join(save_dir, filename + suffix)
+            if os.path.isfile(compressed):
+                sent = filename + suffix
+                headers['Content-Encoding'] = encoding
+                break
+    manifest = get_manifest(save_dir, ref)
+    etag = manifest and manifest.get(os.path.relpath(sent, ref))
+    if etag and request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    elif 'Content-Encoding' in headers:
+        mimetype = (mimetypes.guess_type(filename)[0] or
+                    'application/octet-stream')
+        response = send_from_directory(save_dir, sent, mimetype=mimetype,
+                                       add_etags=not etag)
+    else:
+        response = send_from_directory(save_dir, sent, add_etags=not etag)
+    if etag:
+        response.set_etag(etag)
+    response.headers.extend(headers)
+    if immutable:
+        set_cache_control(response, IMMUTABLE_CACHE_TIMEOUT, immutable=True)
+    else:
+        set_cache_control(response, HEAD_CACHE_TIMEOUT)
+    return response
+
+
+def send_packed_docs(pack, path, immutable=True):
+    """Sends the file of built docs from the ``pack``.  It works like
+    :func:`send_docs()`.
+
+    """
+    entry = pack.find(path)
+    if entry is None:
         abort(404)
-    return send_from_directory(save_dir, os.path.join(ref, path))
+    offset, size, etag = entry['offset'], entry['size'], entry['digest']
+    headers = {}
+    if is_compressible(path):
+        headers['Vary'] = 'Accept-Encoding'
+    encodings = entry.get('encodings', {})
+    for encoding, _ in ENCODINGS:
+        if encoding in encodings and request.accept_encodings[encoding]:
+            offset, size, etag = encodings[encoding]
+            headers['Content-Encoding'] = encoding
+            break
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(pack.read(offset, size),
+                                              mimetype=entry['type'])
+    response.set_etag(etag)
+    response.headers.extend(headers)
+    if immutable:
+        set_cache_control(response, IMMUTABLE_CACHE_TIMEOUT, immutable=True)
+    else:
+        set_cache_control(response, HEAD_CACHE_TIMEOUT)
+    return response
+
+
+def set_cache_control(response, max_age, immutable=False):
+    # Docs are private since they need login, so shared caches must not
+    # store them.
+    cache_control = 'private, max-age={0}'.format(max_age)
+    if immutable:
+        cache_control += ', immutable'
+    response.headers['Cache-Control'] = cache_control
+    response.headers.pop('Expires', None)
+
+
+def get_pack(save_dir, ref):
+    """Gets the :class:`~okydoky.pack.Pack` of ``ref`` through the LRU
+    cache.  Returns ``None`` if the docs of ``ref`` aren't packed.  Packs
+    which have been removed, e.g., by the retention, are closed so that
+    their space is freed.  Other cached packs are checked as well when
+    a pack is mapped.
+
+    """
+    key = save_dir, ref
+    pack = packs.pop(key, None)
+    if pack is not None and pack.is_removed():
+        pack.close()
+        pack = None
+    if pack is None:
+        for cached_key, cached in packs.items():
+            if cached.is_removed():
+                del packs[cached_key]
+                cached.close()
+        try:
+            pack = Pack(os.path.join(save_dir, ref + PACK_SUFFIX))
+        except (IOError, ValueError):
+            return
+    packs[key] = pack
+    while len(packs) > PACK_CACHE_SIZE:
+        _, evicted = packs.popitem(last=False)
+        evicted.close()
+    return pack
+
+
+def get_manifest(save_dir, ref):
+    """Gets the manifest of the published docs of ``ref`` through
+    the LRU cache.  Returns ``None`` if there's no manifest.
+
+    """
+    key = save_dir, ref
+    try:
+        manifest = manifests.pop(key)
+    except KeyError:
+        manifest = read_manifest(os.path.join(save_dir, ref),
+                                 get_config())
+        if manifest is None:
+            return
+    manifests[key] = manifest
+    while len(manifests) > MANIFEST_CACHE_SIZE:
+        manifests.popitem(last=False)
+    return manifest
 
 
 def get_oauth_state():
@@ -184,12 +734,12 @@ def get_oauth_state():
 @app.route('/auth')
 def auth_redirect():
     params = {
-        'client_id': current_app.config['CLIENT_ID'],
-        'redirect_uri': url_for('auth', _external=True),
+        'client_id': get_config()['CLIENT_ID'],
+        'redirect_uri': get_auth_url(),
         'scope': 'repo',
         'state': get_oauth_state()
     }
-    return redirect('https://github.com/login/oauth/authorize?' +
+    return redirect(get_url('/login/oauth/authorize?', get_config()) +
                     url_encode(params))
 
 
@@ -198,29 +748,31 @@ def auth():
     try:
         back = request.args['back']
     except KeyError:
-        redirect_uri = url_for('auth', _external=True)
+        redirect_uri = get_auth_url()
         initial = True
     else:
-        redirect_uri = url_for('auth', back=back, _external=True)
+        redirect_uri = get_auth_url(back=back)
         initial = False
     params = {
-        'client_id': current_app.config['CLIENT_ID'],
-        'client_secret': current_app.config['CLIENT_SECRET'],
+        'client_id': get_config()['CLIENT_ID'],
+        'client_secret': get_config()['CLIENT_SECRET'],
         'redirect_uri': redirect_uri,
         'code': request.args['code'],
         'state': get_oauth_state()
     }
-    response = urllib2.urlopen(
-        'https://github.com/login/oauth/access_token',
-        url_encode(params)
+    response = github.request(
+        'POST', get_url('/login/oauth/access_token', get_config()),
+        body=url_encode(params),
+        headers={'Content-Type': 'application/x-www-form-urlencoded'}
     )
     auth_data = url_decode(response.read())
     response.close()
     token = auth_data['access_token']
     if initial:
-        with open_token_file('w') as f:
-            f.write(token)
-        current_app.config['ACCESS_TOKEN'] = token
+        # The access token is shared by all hosted repositories.
+        root_config = get_root_config(get_config())
+        replace_file('token.txt', token, root_config)
+        tokens.pop(root_config['SAVE_DIRECTORY'], None)
         return_url = url_for('home')
     else:
         return_url = base64.urlsafe_b64decode(str(back))
@@ -235,89 +787,551 @@ def post_receive_hook():
     commits.sort(key=lambda commit: parse_date(commit['timestamp']))
     ids = [(commit['id'], url_for('docs', ref=commit['id'], _external=True))
            for commit in commits]
-    spawn_n(build_main, ids, dict(current_app.config))
+    ids.reverse()
+    config = get_config()
+    selected = select_commits(ids, config)
+    # Tag pushes and branch deletions have no commits; they must not
+    # supersede the latest push.
+    if selected:
+        jobs = get_build_queue(config).push(selected,
+                                            config.get('BUILD_POLICY', 'all'))
+        wakeup = workers.get(config['SAVE_DIRECTORY'])
+        if wakeup is not None:
+            for _ in jobs:
+                wakeup.put(None)
     response = make_response('true', 202)
     response.mimetype = 'application/json'
     return response
 
 
-def build_main(commits, config):
-    logger = logging.getLogger(__name__ + '.build_main')
-    logger.info('triggered with %d commits', len(commits))
-    logger.debug('commits = %r', commits)
-    token = get_token(config)
-    pool = GreenPool()
-    commit_map = dict(commits)
-    commit_ids = [commit_id for commit_id, _ in commits]
-    results = pool.imap(
-        functools.partial(download_archive, token=token, config=config),
-        commit_ids
-    )
-    env = make_virtualenv(config)
+def select_commits(commits, config):
+    """Selects commits to build from ``commits`` (the newest first)
+    according to ``BUILD_POLICY`` config.
+
+    """
+    policy = config.get('BUILD_POLICY', 'all')
+    if policy == 'latest':
+        return commits[:1]
+    elif policy == 'all':
+        return commits
+    elif policy == 'every-nth':
+        return commits[::config.get('BUILD_POLICY_N', 10)]
+    raise ValueError('BUILD_POLICY must be one of {0!r}, not {1!r}'.format(
+        BUILD_POLICIES, policy
+    ))
+
+
+def start_workers(config):
+    """Starts the build pipeline for the ``SAVE_DIRECTORY`` of ``config``
+    in this process if it hasn't started yet.  Up to
+    ``MAX_CONCURRENT_BUILDS`` jobs are taken from the queue at once.  Jobs
+    interrupted by the last shutdown are resumed.
+
+    If ``REPOSITORIES`` is set, all repositories share the pipeline, and
+    jobs are taken from their queues in turn.
+
+    :returns: the :class:`~eventlet.queue.LightQueue` to wake up workers
+
+    """
+    logger = logging.getLogger(__name__ + '.start_workers')
     save_dir = config['SAVE_DIRECTORY']
-    complete_hook = config.get('COMPLETE_HOOK')
-    for commit, filename in results:
-        working_dir = extract(filename, save_dir)
+    try:
+        return workers[save_dir]
+    except KeyError:
+        pass
+    wakeup = workers[save_dir] = LightQueue()
+    queues = []
+    recovered = 0
+    for repo_config in get_repository_configs(config):
+        queue = get_build_queue(repo_config)
+        workers[repo_config['SAVE_DIRECTORY']] = wakeup
+        queues.append((queue, repo_config))
+        recovered += queue.recover()
+        if repo_config.get('RETAIN_BUILDS') is not None:
+            trigger = sweepers[repo_config['SAVE_DIRECTORY']] = LightQueue()
+            trigger.put(None)
+            spawn_n(sweep_builds, trigger, repo_config)
+    concurrency = dict(DEFAULT_PIPELINE_CONCURRENCY)
+    concurrency.update(config.get('PIPELINE_CONCURRENCY', {}))
+    pipeline = Pipeline([(name, function, concurrency[name])
+                         for name, function in BUILD_STAGES],
+                        finish_build)
+    slots = Semaphore(config.get('MAX_CONCURRENT_BUILDS',
+                                 multiprocessing.cpu_count() * 2))
+    spawn_n(dispatch_jobs, queues, wakeup, slots, pipeline)
+    spawn_n(keep_leases, queues, wakeup)
+    logger.info('started the build pipeline for %s (%s); %d jobs resumed',
+                ', '.join(c['SAVE_DIRECTORY'] for _, c in queues),
+                ', '.join('{0}: {1}'.format(name, concurrency[name])
+                          for name, _ in BUILD_STAGES),
+                recovered)
+    return wakeup
+
+
+def dispatch_jobs(queues, wakeup, slots, pipeline):
+    """Takes jobs from ``queues``, the list of pairs of the build queue
+    and the config of each repository, and puts them into the ``pipeline``.
+    Queues are looked into in turn, so that a busy repository doesn't
+    starve others.
+
+    """
+    turn = 0
+    while 1:
+        slots.acquire()
+        for i in xrange(len(queues)):
+            queue, config = queues[(turn + i) % len(queues)]
+            job = queue.claim()
+            if job is not None:
+                turn = (turn + i + 1) % len(queues)
+                break
+        else:
+            slots.release()
+            try:
+                wakeup.get(timeout=QUEUE_POLL_INTERVAL)
+            except Empty:
+                pass
+            continue
+        BUILDS_RUNNING.inc()
+        pipeline.put({'job': job, 'queue': queue, 'slots': slots,
+                      'config': config, 'timings': {}})
+
+
+def keep_leases(queues, wakeup):
+    """Renews leases of jobs this process claimed, and makes jobs whose
+    leases have expired, e.g. because their node has gone, pending again
+    every :const:`~okydoky.buildqueue.HEARTBEAT_INTERVAL` seconds.
+
+    """
+    logger = logging.getLogger(__name__ + '.keep_leases')
+    while 1:
+        sleep(HEARTBEAT_INTERVAL)
+        for queue, _ in queues:
+            try:
+                queue.heartbeat()
+                if queue.recover():
+                    wakeup.put(None)
+            except EnvironmentError:
+                logger.exception('failed to keep leases of %s', queue.path)
+
+
+def fetch_stage(build):
+    logger = logging.getLogger(__name__ + '.fetch_stage')
+    config = build['config']
+    commit = build['job']['commit']
+    if is_published(os.path.join(config['SAVE_DIRECTORY'], commit)):
+        logger.info('%s has already been built; skip...', commit)
+        build['skipped'] = True
+        return False
+    queue = build['queue']
+    build['sandbox'] = Sandbox(config, lambda: queue.is_cancelled(commit))
+    build['sandbox'].check()
+    build['log'] = open_log(commit, config)
+    build['working_dir'] = fetch_archive(commit, get_token(config), config,
+                                         build['timings'])
+    if config.get('REUSE_BUILDS', True):
+        with timed(build['timings'], 'fingerprint'):
+            build['fingerprint'] = tpool.execute(
+                get_fingerprint, build['working_dir'], config
+            )
+        if reuse_build(build):
+            return False
+    build['working_dir'], build['work_lock'] = lease_work_dir(
+        build['working_dir'], config
+    )
+
+
+def reuse_build(build):
+    """Publishes the docs of an already published commit whose docs
+    inputs have the same fingerprint as the ``build``, instead of building
+    them again.  Returns ``False`` if there's no such commit.
+
+    """
+    logger = logging.getLogger(__name__ + '.reuse_build')
+    config = build['config']
+    commit = build['job']['commit']
+    timings = build['timings']
+    index = get_build_index(config)
+    result_dir = os.path.join(config['SAVE_DIRECTORY'], commit)
+    for source in index.find_fingerprint(build['fingerprint']):
+        source_dir = os.path.join(config['SAVE_DIRECTORY'], source)
+        if source == commit.lower() or not is_published(source_dir):
+            continue
         try:
-            build = build_sphinx(working_dir, env)
+            with timed(timings, 'publish'):
+                size = tpool.execute(clone, source_dir, result_dir, config)
+        except EnvironmentError:
+            # The build could be evicted meanwhile.
+            logger.warning('failed to reuse the build of %s', source,
+                           exc_info=1)
+            continue
+        break
+    else:
+        return False
+    if config.get('SEARCH_INDEX', True):
+        try:
+            with timed(timings, 'search_index'):
+                tpool.execute(get_search_index(config).copy, source, commit)
         except Exception:
-            permalink = commit_map[commit]
-            if not config.get('RECREATE_VIRTUALENV'):
-                env = make_virtualenv(config, recreate=True)
-                try:
-                    build = build_sphinx(working_dir, env)
-                except Exception:
-                    if callable(complete_hook):
-                        complete_hook(commit, permalink, sys.exc_info())
-                    continue
+            logger.exception('failed to index %s', result_dir)
+    print >> build['log'], ('docs inputs are the same as {0}; '
+                            'reuse its build'.format(source))
+    timings['total'] = time.time() - build['job']['enqueued_at']
+    BUILD_LATENCY_SECONDS.observe(timings['total'])
+    # Cloned files are hard-linked, so they take no extra space.
+    DEDUP_SAVED_BYTES.inc(size)
+    source_build = index.get(source)
+    index.add(commit, 'success', size=size, saved=size,
+              has_log=source_build is not None and source_build['has_log'],
+              timings=timings, fingerprint=build['fingerprint'])
+    logger.info('reused the build of %s: %s', source, result_dir)
+    tpool.execute(shutil.rmtree, build['working_dir'])
+    return True
+
+
+def install_stage(build):
+    logger = logging.getLogger(__name__ + '.install_stage')
+    config = build['config']
+    build['sandbox'].check()
+    build['sphinx_env'] = install_sphinx(config, build['log'],
+                                         build['timings'], build['sandbox'],
+                                         get_package_cache(config))
+    build['env_key'] = get_env_key(build['working_dir'], config)
+    with timed(build['timings'], 'virtualenv'):
+        build['env'], build['warm'] = get_env_pool(config).acquire(
+            build['env_key'], recreate=config.get('RECREATE_VIRTUALENV')
+        )
+    try:
+        install_dependencies(build['working_dir'], build['env'],
+                             build['warm'], build['log'], build['timings'],
+                             build['sandbox'], get_package_cache(config),
+                             build['sphinx_env'])
+    except BuildAborted:
+        raise
+    except Exception:
+        if not build['warm']:
+            raise
+        logger.info('failed to install dependencies into the warm '
+                    'virtualenv; try again with a new one', exc_info=1)
+        reinstall_dependencies(build)
+
+
+def reinstall_dependencies(build):
+    """Installs dependencies of the ``build`` into a new virtualenv,
+    since its warm virtualenv might be broken.
+
+    """
+    pool = get_env_pool(build['config'])
+    pool.release(build.pop('env'))
+    with timed(build['timings'], 'virtualenv'):
+        build['env'], build['warm'] = pool.acquire(build['env_key'],
+                                                   recreate=True)
+    install_dependencies(build['working_dir'], build['env'], build['warm'],
+                         build['log'], build['timings'], build['sandbox'],
+                         get_package_cache(build['config']),
+                         build['sphinx_env'])
+
+
+def sphinx_stage(build):
+    logger = logging.getLogger(__name__ + '.sphinx_stage')
+    config = build['config']
+    build['sandbox'].check()
+    try:
+        build['output'] = build_sphinx(build['working_dir'], build['env'],
+                                       build['log'], config,
+                                       build['timings'], build['sandbox'])
+    except BuildAborted:
+        raise
+    except Exception:
+        if not build['warm']:
+            raise
+        logger.info('failed to build in the warm virtualenv; '
+                    'try again with a new one', exc_info=1)
+        reinstall_dependencies(build)
+        build['output'] = build_sphinx(build['working_dir'], build['env'],
+                                       build['log'], config,
+                                       build['timings'], build['sandbox'])
+    get_env_pool(config).mark_ready(build['env'])
+
+
+def publish_stage(build):
+    logger = logging.getLogger(__name__ + '.publish_stage')
+    config = build['config']
+    build['sandbox'].check()
+    result_dir = os.path.join(config['SAVE_DIRECTORY'], build['job']['commit'])
+    timings = build['timings']
+    if config.get('SEARCH_INDEX', True):
+        try:
+            with timed(timings, 'search_index'):
+                tpool.execute(get_search_index(config).add,
+                              build['job']['commit'], build['output'])
+        except Exception:
+            logger.exception('failed to index %s', build['output'])
+    with timed(timings, 'compress'):
+        tpool.execute(compress_build, build['output'], config)
+    has_log = os.path.isfile(os.path.join(build['output'], 'build.txt'))
+    with timed(timings, 'publish'):
+        size, saved = tpool.execute(publish, build['output'], result_dir,
+                                    config)
+    timings['total'] = time.time() - build['job']['enqueued_at']
+    BUILD_LATENCY_SECONDS.observe(timings['total'])
+    DEDUP_SAVED_BYTES.inc(saved)
+    get_build_index(config).add(build['job']['commit'], 'success',
+                                size=size, saved=saved, has_log=has_log,
+                                timings=timings,
+                                fingerprint=build.get('fingerprint'))
+    logger.info('build complete: %s' % result_dir)
+    working_dir = build['working_dir']
+    tpool.execute(shutil.rmtree, working_dir)
+    logger.info('working directory %s has removed' % working_dir)
+    trigger = sweepers.get(config['SAVE_DIRECTORY'])
+    if (trigger is not None and
+            get_disk_usage(config['SAVE_DIRECTORY']) >
+            config.get('DISK_HIGH_WATERMARK', 0.9)):
+        trigger.put(None)
+
+
+#: (:class:`collections.Sequence`) The pairs of the name and the function of
+#: each stage of the build pipeline.
+BUILD_STAGES = [
+    ('fetch', fetch_stage),
+    ('install', install_stage),
+    ('sphinx', sphinx_stage),
+    ('publish', publish_stage)
+]
+
+#: (:class:`collections.Mapping`) The default number of workers of each
+#: stage of the build pipeline.  It can be overridden by
+#: ``PIPELINE_CONCURRENCY`` config.
+DEFAULT_PIPELINE_CONCURRENCY = {
+    'fetch': 4,
+    'install': 2,
+    'sphinx': multiprocessing.cpu_count(),
+    'publish': 2
+}
+
+
+def sweep_builds(trigger, config):
+    """Evicts old builds every ``RETENTION_INTERVAL`` seconds, or when
+    it's triggered.
+
+    """
+    logger = logging.getLogger(__name__ + '.sweep_builds')
+    interval = config.get('RETENTION_INTERVAL', 60 * 60)
+    while 1:
+        try:
+            trigger.get(timeout=interval)
+        except Empty:
+            pass
+        # Triggers piled up while sweeping are handled by a single sweep.
+        while not trigger.empty():
+            trigger.get()
+        try:
+            protected = set()
+            head = get_head(config)
+            if head is not None:
+                protected.add(head)
+            if config.get('RETAIN_TAGS', True):
+                protected.update(get_tagged_commits(get_token(config),
+                                                    config))
+            # Only one node sweeps the SAVE_DIRECTORY at a time.
+            lock = FileLock(os.path.join(config['SAVE_DIRECTORY'],
+                                         '.sweep.lock'))
+            if not lock.acquire(blocking=False):
+                logger.info('%s is being swept by another node; skip...',
+                            config['SAVE_DIRECTORY'])
+                continue
+            try:
+                tpool.execute(sweep, get_build_index(config), protected,
+                              config)
+            finally:
+                lock.release()
+        except Exception:
+            logger.exception('failed to sweep old builds')
+
+
+def finish_build(build, exc_info):
+    """Finishes the ``build`` which has left the pipeline.  The commit
+    becomes the new head if it's the newest built commit of the latest push.
+
+    """
+    logger = logging.getLogger(__name__ + '.finish_build')
+    job = build['job']
+    commit = job['commit']
+    config = build['config']
+    if build.get('skipped'):
+        status = 'skipped'
+    elif exc_info is None:
+        status = 'success'
+    elif issubclass(exc_info[0], BuildCancelled):
+        status = 'cancelled'
+    else:
+        status = 'failure'
+    BUILDS_RUNNING.dec()
+    BUILDS_TOTAL.inc(status=status)
+    try:
+        if 'env' in build:
+            get_env_pool(config).release(build['env'])
+        if 'work_lock' in build:
+            build['work_lock'].release()
+        if 'log' in build:
+            if exc_info is not None and issubclass(exc_info[0],
+                                                   BuildAborted):
+                print >> build['log'], exc_info[1]
+            elif exc_info is not None:
+                print >> build['log']
+                traceback.print_exception(*exc_info, file=build['log'])
+            build['log'].close()
+        if exc_info is not None:
+            if status == 'cancelled':
+                logger.info('cancelled the build of %s', commit)
+            else:
+                logger.error('failed to build %s', commit, exc_info=exc_info)
+            get_build_index(config).add(commit, status,
+                                        has_log='log' in build,
+                                        timings=build['timings'])
+        if not build.get('skipped'):
+            complete_hook = config.get('COMPLETE_HOOK')
             if callable(complete_hook):
-                complete_hook(commit, permalink, sys.exc_info())
-            continue
-        result_dir = os.path.join(save_dir, commit)
-        shutil.move(build, result_dir)
-        logger.info('build complete: %s' % result_dir)
-        if callable(complete_hook):
-            complete_hook(commit, commit_map[commit], None)
-        shutil.rmtree(working_dir)
-        logger.info('working directory %s has removed' % working_dir)
-        with open_head_file('w', config=config) as f:
-            f.write(commit)
-    logger.info('new head: %s', commits[0])
+                complete_hook(commit, job['permalink'], exc_info)
+        if exc_info is None and build['queue'].promote(job):
+            set_head(commit, config)
+            logger.info('new head: %s', commit)
+    finally:
+        build['queue'].complete(job)
+        build['slots'].release()
+
+
+def fetch_archive(commit, token, config, timings=None):
+    """Downloads the archive of the ``commit`` and extracts it into
+    the ``SAVE_DIRECTORY``.  Unless ``STREAM_ARCHIVES`` is turned off,
+    the archive is extracted while it's being downloaded, without saving
+    it to a file, and the time of extraction counts in ``'download'``
+    phase of ``timings``.  The archive is piped to the extraction which
+    runs in a thread, so that it doesn't block other green threads.
+    Returns the path of the extracted directory.
+
+    """
+    logger = logging.getLogger(__name__ + '.fetch_archive')
+    save_dir = config['SAVE_DIRECTORY']
+    include = config.get('ARCHIVE_INCLUDE')
+    if not config.get('STREAM_ARCHIVES', True):
+        with timed(timings, 'download'):
+            _, filename = download_archive(commit, token, config)
+        with timed(timings, 'extract'):
+            return tpool.execute(extract, filename, save_dir, include)
+    logger.info('start streaming archive %s', commit)
+    path = '/repos/{0}/tarball/{1}'.format(config['REPOSITORY'], commit)
+    url = get_api_url(path, config)
+    with timed(timings, 'download'):
+        response = github.request('GET', url, token=token, buffered=False)
+        try:
+            read_fd, write_fd = os.pipe()
+            extraction = spawn(tpool.execute, extract_stream, read_fd,
+                               save_dir, include)
+            reader = CountingReader(response, ARCHIVE_BYTES)
+            writer = GreenPipe(write_fd, 'wb', 0)
+            try:
+                while 1:
+                    chunk = reader.read(65536)
+                    if not chunk:
+                        break
+                    try:
+                        writer.write(chunk)
+                    except IOError as e:
+                        # The extraction has failed; its error is raised.
+                        if e.errno != errno.EPIPE:
+                            raise
+                        break
+            finally:
+                writer.close()
+            dirname = extraction.wait()
+        finally:
+            response.close()
+    result_path = os.path.join(save_dir, dirname)
+    logger.info('archive %s has extracted to %s', commit, result_path)
+    return result_path
+
+
+def extract_stream(fd, path, include=None):
+    """Extracts the gzipped tarball read from the file descriptor ``fd``
+    into ``path``, and closes ``fd``.  Returns the name of the top
+    directory of the archive.
+
+    """
+    dirname = None
+    with os.fdopen(fd, 'rb') as f:
+        tar = tarfile.open(fileobj=f, mode='r|gz')
+        for member in tar:
+            if dirname is None:
+                dirname = member.name.split('/', 1)[0]
+            if is_extractable(member, include):
+                tar.extract(member, path)
+        tar.close()
+    return dirname
+
+
+def is_extractable(member, include=None):
+    """Tests whether the tar ``member`` is safe to extract, and matches
+    one of ``include`` patterns.  Patterns are relative to the root of
+    the repository, and a directory pattern includes all files in it.
+
+    """
+    names = [member.name]
+    if member.issym():
+        names.append(os.path.join(os.path.dirname(member.name),
+                                  member.linkname))
+    elif member.islnk():
+        names.append(member.linkname)
+    for name in names:
+        if os.path.isabs(name) or os.path.normpath(name).startswith('..'):
+            return False
+    if include is None:
+        return True
+    relpath = member.name.partition('/')[2]
+    if not relpath:
+        return True
+    for pattern in include:
+        pattern = pattern.rstrip('/')
+        if (fnmatch.fnmatch(relpath, pattern) or
+                relpath.startswith(pattern + '/')):
+            return True
+    return False
 
 
 def download_archive(commit, token, config):
     logger = logging.getLogger(__name__ + '.download_archive')
     logger.info('start downloading archive %s', commit)
-    url_p = 'https://api.github.com/repos/{0}/tarball/{1}?access_token={2}'
-    url = url_p.format(config['REPOSITORY'], commit, token)
-    while 1:
-        response = urllib2.urlopen(url)
-        try:
-            url = response.info()['Location']
-        except KeyError:
-            break
+    path = '/repos/{0}/tarball/{1}'.format(config['REPOSITORY'], commit)
+    url = get_api_url(path, config)
+    response = github.request('GET', url, token=token, buffered=False)
     filename = os.path.join(config['SAVE_DIRECTORY'], commit + '.tar.gz')
     logger.debug('save %s into %s', commit, filename)
     logger.debug('filesize of %s: %s',
-                 filename, response.info().get('Content-Length', 'none'))
-    with open(filename, 'wb') as f:
-        while 1:
-            chunk = response.read(4096)
-            if chunk:
-                f.write(chunk)
-                continue
-            break
+                 filename, response.headers.get('content-length', 'none'))
+    try:
+        with open(filename, 'wb') as f:
+            while 1:
+                chunk = response.read(4096)
+                if chunk:
+                    f.write(chunk)
+                    ARCHIVE_BYTES.inc(len(chunk))
+                    continue
+                break
+    finally:
+        response.close()
     logger.info('finish downloading archive %s: %s', commit, filename)
     return commit, filename
 
 
-def extract(filename, path):
+def extract(filename, path, include=None):
     logger = logging.getLogger(__name__ + '.extract')
     logger.info('extracting %s...', filename)
     tar = tarfile.open(filename)
     logger.debug('tar.getnames() = %r', tar.getnames())
     dirname = tar.getnames()[0]
-    tar.extractall(path)
+    tar.extractall(path, [member for member in tar.getmembers()
+                          if is_extractable(member, include)])
+    tar.close()
     result_path = os.path.join(path, dirname)
     logger.info('%s has extracted to %s', filename, result_path)
     os.unlink(filename)
@@ -325,53 +1339,156 @@ def extract(filename, path):
     return result_path
 
 
-def build_sphinx(path, env):
-    logger = logging.getLogger(__name__ + '.build_sphinx')
-    logs = []
-    def run(cmd, **kwargs):
-        command = ' '.join(map(repr, cmd))
-        logger.debug(command)
-        logs.append('$ ' + command)
-        result = subprocess.check_output(cmd, stderr=subprocess.STDOUT,
-                                         **kwargs)
-        logs.append(result)
+def run_command(cmd, log, phase=None, sandbox=None, **kwargs):
+    """Runs the command, and writes its output into the ``log`` file
+    line by line.  The command is limited by the ``sandbox`` as a part of
+    the ``phase``.
+
+    :raises subprocess.CalledProcessError: when the command fails
+    :raises okydoky.sandbox.BuildAborted: when the command has been killed
+                                          because of the timeout or
+                                          the cancellation
+
+    """
+    logger = logging.getLogger(__name__ + '.run_command')
+    if sandbox is None:
+        sandbox = Sandbox()
+    command = ' '.join(map(repr, cmd))
+    logger.debug(command)
+    print >> log, '$ ' + command
+    log.flush()
+    kwargs.update(sandbox.get_popen_options())
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, **kwargs)
+    with sandbox.watch(process, phase):
+        for line in iter(process.stdout.readline, ''):
+            log.write(line)
+            log.flush()
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def get_bindir(env):
     if sys.platform == 'win32':
-        bindir = os.path.join(env, 'Scripts')
-    else:
-        bindir = os.path.join(env, 'bin')
+        return os.path.join(env, 'Scripts')
+    return os.path.join(env, 'bin')
+
+
+def get_build_environ():
+    environ = os.environ.copy()
+    environ['OKYDOKY'] = '1'
+    return environ
+
+
+@contextlib.contextmanager
+def install_options(cache=None):
+    """Yields options of ``easy_install`` and ``setup.py develop``.
+    Distributions are installed from the package ``cache`` first if it's
+    given, otherwise the package index is searched for the latest versions.
+
+    """
+    if cache is None:
+        yield ['--upgrade']
+        return
+    with cache.options() as options:
+        yield options
+
+
+def install_sphinx(config, log, timings=None, sandbox=None, cache=None):
+    """Installs Sphinx into the virtualenv shared by builds of all
+    repositories unless it's already done, and returns its path.
+    Commands are limited by the ``sandbox``, and distributions are
+    installed from the package ``cache`` first.
+
+    """
+    logger = logging.getLogger(__name__ + '.install_sphinx')
+    pool = get_env_pool(config)
+    env = pool.get_sphinx_env()
+    if pool.is_ready(env):
+        return env
+    with FileLock(env + '.lock'):
+        # Another build could install it while waiting for the lock.
+        if pool.is_ready(env):
+            return env
+        logger.info('installing Sphinx into %s...', env)
+        with timed(timings, 'easy_install'):
+            if os.path.isdir(env):
+                tpool.execute(shutil.rmtree, env)
+            tpool.execute(create_virtualenv, env)
+            with install_options(cache) as options:
+                run_command([os.path.join(get_bindir(env), 'easy_install')] +
+                            options + [SPHINX_REQUIREMENT],
+                            log, 'easy_install', sandbox)
+        pool.mark_ready(env)
+    return env
+
+
+def install_dependencies(path, env, warm, log, timings=None, sandbox=None,
+                         cache=None, sphinx_env=None):
+    """Installs the project in ``path`` into the virtualenv ``env`` in
+    development mode.  Dependencies are installed as well unless the
+    virtualenv is ``warm``.  Commands are limited by the ``sandbox``,
+    and distributions are installed from the package ``cache`` first.
+
+    Sphinx is taken from the shared virtualenv ``sphinx_env`` if it's
+    given, otherwise it's installed into ``env`` as well.
+
+    """
+    logger = logging.getLogger(__name__ + '.install_dependencies')
+    bindir = get_bindir(env)
     python = os.path.join(bindir, 'python')
-    env = os.environ.copy()
-    env['OKYDOKY'] = '1'
+    environ = get_build_environ()
+    if sphinx_env is not None:
+        link_sphinx_env(env, sphinx_env)
+    if warm:
+        logger.info('dependencies are already installed')
+        with timed(timings, 'develop'):
+            run_command([python, 'setup.py', 'develop', '--no-deps'], log,
+                        'develop', sandbox, cwd=path, env=environ)
+        return
     logger.info('installing dependencies...')
-    run([python, 'setup.py', 'develop', '--upgrade'], cwd=path, env=env)
+    with timed(timings, 'develop'):
+        with install_options(cache) as options:
+            run_command([python, 'setup.py', 'develop'] + options, log,
+                        'develop', sandbox, cwd=path, env=environ)
+    if sphinx_env is not None:
+        return
     logger.info('installing Sphinx...')
-    run([os.path.join(bindir, 'easy_install'), 'Sphinx'])
+    with timed(timings, 'easy_install'):
+        with install_options(cache) as options:
+            run_command([os.path.join(bindir, 'easy_install')] + options +
+                        [SPHINX_REQUIREMENT], log, 'easy_install', sandbox)
+
+
+def build_sphinx(path, env, log, config=None, timings=None, sandbox=None):
+    """Builds the documentation of the project in ``path`` using Sphinx
+    installed in the virtualenv ``env``.  Returns the path of the built
+    HTML docs, which contains the copy of the ``log`` file as ``build.txt``.
+    Commands are limited by the ``sandbox``.
+
+    """
+    logger = logging.getLogger(__name__ + '.build_sphinx')
+    python = os.path.join(get_bindir(env), 'python')
+    incremental = config is not None and config.get('INCREMENTAL_BUILD', True)
+    if incremental:
+        with timed(timings, 'restore_cache'):
+            cache_key = get_cache_key(path, python, config)
+            manifest = tpool.execute(restore_cache, path, cache_key, config)
     logger.info('building documentation using Sphinx...')
-    run([python, 'setup.py', 'build_sphinx'], cwd=path, env=env)
-    run([python, 'setup.py', 'develop', '--uninstall'], cwd=path)
+    with timed(timings, 'build_sphinx'):
+        run_command([python, 'setup.py', 'build_sphinx'], log,
+                    'build_sphinx', sandbox, cwd=path, env=get_build_environ())
+    run_command([python, 'setup.py', 'develop', '--uninstall'], log,
+                'develop', sandbox, cwd=path)
+    if incremental:
+        try:
+            with timed(timings, 'store_cache'):
+                tpool.execute(store_cache, path, cache_key, manifest, config)
+        except EnvironmentError:
+            logger.exception('failed to store the doctree cache')
     build = os.path.join(path, 'build', 'sphinx', 'html')
-    with open(os.path.join(build, 'build.txt'), 'w') as log_file:
-        for log_line in logs:
-            print >> log_file, log_line
+    log.flush()
+    shutil.copyfile(log.name, os.path.join(build, 'build.txt'))
     logger.info('documentation: %s', build)
     return build
-
-
-def make_virtualenv(config, recreate=False):
-    logger = logging.getLogger(__name__ + '.make_virtualenv')
-    save_dir = config['SAVE_DIRECTORY']
-    envdir = os.path.join(save_dir, '_env')
-    if os.path.isdir(envdir):
-        if not config.get('RECREATE_VIRTUALENV', recreate):
-            logger.info('virtualenv already exists: %s; skip...' % envdir)
-            return envdir
-        logger.info('virtualenv already exists: %s; remove...' % envdir)
-        shutil.rmtree(envdir)
-    logger.info('creating new virtualenv: %s' % envdir)
-    if (pkg_resources.parse_version(virtualenv_version) <
-            pkg_resources.parse_version('1.10.1')):
-        create_environment(envdir, use_distribute=True)
-    else:
-        create_environment(envdir)
-    logger.info('created virtualenv: %s' % envdir)
-    return envdir
@@ -0,0 +1,326 @@
+""":mod:`okydoky.bench` --- Benchmark of the build pipeline
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures how long it takes from post-receive hooks to published docs,
+without GitHub.  It starts a fake GitHub which serves archives of
+a synthetic Sphinx project, fires post-receive hooks to Okydoky running
+in the same process, and reports the throughput and percentiles of
+the seconds spent in each build phase:
+
+.. code-block:: console
+
+   $ python -m okydoky.bench --pushes 3 --commits 5 --pages 200
+
+Builds actually run in virtualenvs, so Sphinx is installed from PyPI
+when the first virtualenv is made.  Pass the same ``--save-directory``
+again to measure builds with warm virtualenvs and caches.
+
+"""
+from __future__ import absolute_import
+
+import datetime
+import hashlib
+import io
+import logging
+import math
+import optparse
+import os
+import os.path
+import random
+import re
+import sys
+import tarfile
+import tempfile
+import time
+
+from eventlet import listen, sleep, spawn_n
+from eventlet.wsgi import server
+from flask import json
+from werkzeug.urls import url_encode
+from werkzeug.wrappers import Request, Response
+
+from .app import app, get_build_index, get_build_queue, start_workers
+
+
+#: (:class:`str`) The access token the fake GitHub issues.
+TOKEN = 'bench-token'
+
+#: (:class:`str`) The repository name to benchmark.
+REPOSITORY = 'okydoky-bench/project'
+
+#: (:class:`list`) Words which synthetic pages are made of.
+WORDS = ('okydoky sphinx github build docs commit hook archive virtualenv '
+         'pipeline index search cache publish object queue worker head '
+         'retention metrics latency throughput percentile').split()
+
+SETUP_PY = '''\
+from setuptools import setup
+
+setup(name='benchproject', version='1.0', py_modules=['benchproject'])
+'''
+
+SETUP_CFG = '''\
+[build_sphinx]
+source-dir = docs
+build-dir = build/sphinx
+'''
+
+CONF_PY = '''\
+project = 'benchproject'
+version = release = '1.0'
+master_doc = 'index'
+extensions = []
+'''
+
+
+class SyntheticProject(object):
+    """The synthetic setuptools project with Sphinx docs.  Each commit
+    changes one page, so that incremental builds have something to do.
+
+    :param pages: the number of pages
+    :param paragraphs: the number of paragraphs of each page
+
+    """
+
+    def __init__(self, pages=50, paragraphs=20):
+        self.pages = pages
+        self.paragraphs = paragraphs
+
+    def make_page(self, number, revision=None):
+        rng = random.Random(number)
+        title = 'Page {0}'.format(number)
+        lines = [title, '=' * len(title), '']
+        if revision is not None:
+            lines.extend(['Revision ``{0}``.'.format(revision), ''])
+        for _ in xrange(self.paragraphs):
+            words = [rng.choice(WORDS) for _ in xrange(rng.randint(20, 80))]
+            lines.extend([' '.join(words).capitalize() + '.', ''])
+        return '\n'.join(lines)
+
+    def get_files(self, commit):
+        changed = int(commit[:8], 16) % self.pages
+        index = ['Benchmark', '=========', '', '.. toctree::', '']
+        index.extend('   page{0}'.format(i) for i in xrange(self.pages))
+        files = {
+            'setup.py': SETUP_PY,
+            'setup.cfg': SETUP_CFG,
+            'benchproject.py': '"""Benchmark project."""\n',
+            'docs/conf.py': CONF_PY,
+            'docs/index.rst': '\n'.join(index) + '\n'
+        }
+        for i in xrange(self.pages):
+            revision = commit if i == changed else None
+            files['docs/page{0}.rst'.format(i)] = self.make_page(i, revision)
+        return files
+
+    def make_archive(self, commit):
+        """Makes the tarball of the ``commit`` like GitHub does."""
+        root = 'okydoky-bench-project-' + commit[:7]
+        buffer_ = io.BytesIO()
+        tar = tarfile.open(fileobj=buffer_, mode='w:gz')
+        info = tarfile.TarInfo(root)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0755
+        tar.addfile(info)
+        for name, content in sorted(self.get_files(commit).iteritems()):
+            info = tarfile.TarInfo(root + '/' + name)
+            info.size = len(content)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(content))
+        tar.close()
+        return buffer_.getvalue()
+
+
+class FakeGitHub(object):
+    """The WSGI application which stands in for GitHub endpoints Okydoky
+    calls: the OAuth access token, the repository, its tags and tarballs.
+    Tarballs are redirected to another path as GitHub does.
+
+    :param project: the :class:`SyntheticProject` to serve
+
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self.requests = {}
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        response = self.dispatch(request)
+        return response(environ, start_response)
+
+    def count(self, endpoint):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def dispatch(self, request):
+        path = request.path
+        if path == '/login/oauth/access_token' and request.method == 'POST':
+            self.count('access_token')
+            return Response(url_encode({'access_token': TOKEN,
+                                        'token_type': 'bearer'}),
+                            mimetype='application/x-www-form-urlencoded')
+        match = re.match(r'^/repos/([^/]+/[^/]+)/tarball/([0-9a-f]{40})$',
+                         path)
+        if match:
+            self.count('tarball')
+            location = '/_codeload/{0}/tar.gz/{1}'.format(*match.groups())
+            return Response('', 302, {'Location': location})
+        match = re.match(r'^/_codeload/[^/]+/[^/]+/tar\.gz/([0-9a-f]{40})$',
+                         path)
+        if match:
+            self.count('codeload')
+            return Response(self.project.make_archive(match.group(1)),
+                            mimetype='application/x-gzip')
+        match = re.match(r'^/repos/([^/]+/[^/]+)/tags$', path)
+        if match:
+            self.count('tags')
+            return Response('[]', mimetype='application/json')
+        match = re.match(r'^/repos/([^/]+/[^/]+)$', path)
+        if match:
+            self.count('repository')
+            repo = {'full_name': match.group(1),
+                    'permissions': {'admin': False, 'push': False,
+                                    'pull': True}}
+            return Response(json.dumps(repo), mimetype='application/json')
+        self.count('not_found')
+        return Response('{"message": "Not Found"}', 404,
+                        mimetype='application/json')
+
+
+def make_payload(commits, started_at):
+    return {
+        'repository': {'name': REPOSITORY.split('/')[1]},
+        'commits': [
+            {
+                'id': commit,
+                'url': 'https://github.com/{0}/commit/{1}'.format(REPOSITORY,
+                                                                  commit),
+                'timestamp': (started_at + datetime.timedelta(seconds=i))
+                             .strftime('%Y-%m-%dT%H:%M:%S+00:00')
+            }
+            for i, commit in enumerate(commits)
+        ]
+    }
+
+
+def is_idle(queue):
+    if queue.pending():
+        return False
+    return not any(name.endswith('.running')
+                   for name in os.listdir(queue.path))
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of ``values``."""
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+def report(builds, elapsed, fake, out=sys.stdout):
+    """Prints the result of the benchmark."""
+    succeeded = [b for b in builds.itervalues()
+                 if b is not None and b['status'] == 'success']
+    failed = [b for b in builds.itervalues()
+              if b is not None and b['status'] != 'success']
+    dropped = sum(1 for b in builds.itervalues() if b is None)
+    print >> out, 'commits: {0}, succeeded: {1}, failed: {2}, ' \
+                  'not built: {3}'.format(len(builds), len(succeeded),
+                                          len(failed), dropped)
+    print >> out, 'elapsed: {0:.1f}s, throughput: {1:.2f} builds/min'.format(
+        elapsed, len(succeeded) * 60.0 / elapsed if elapsed else 0
+    )
+    phases = {}
+    for build in succeeded + failed:
+        for phase, seconds in build['timings'].iteritems():
+            phases.setdefault(phase, []).append(seconds)
+    if phases:
+        print >> out
+        print >> out, '{0:<16} {1:>5} {2:>9} {3:>9} {4:>9} {5:>9}'.format(
+            'phase', 'n', 'p50', 'p90', 'p99', 'max'
+        )
+        for phase in sorted(phases, key=lambda p: (p == 'total', p)):
+            values = phases[phase]
+            print >> out, ('{0:<16} {1:>5} {2:>8.2f}s {3:>8.2f}s '
+                           '{4:>8.2f}s {5:>8.2f}s').format(
+                phase, len(values), percentile(values, 50),
+                percentile(values, 90), percentile(values, 99), max(values)
+            )
+    print >> out
+    print >> out, 'requests to the fake GitHub: ' + ', '.join(
+        '{0}: {1}'.format(k, v) for k, v in sorted(fake.requests.iteritems())
+    )
+
+
+parser = optparse.OptionParser(usage='%prog [options]')
+parser.add_option('--pushes', type='int', default=1,
+                  help='the number of pushes [%default]')
+parser.add_option('--commits', type='int', default=1,
+                  help='the number of commits of each push [%default]')
+parser.add_option('--interval', type='float', default=0,
+                  help='the seconds between pushes [%default]')
+parser.add_option('--pages', type='int', default=50,
+                  help='the number of pages of the project [%default]')
+parser.add_option('--paragraphs', type='int', default=20,
+                  help='the number of paragraphs of each page [%default]')
+parser.add_option('--policy', default='all',
+                  help='the BUILD_POLICY config [%default]')
+parser.add_option('--save-directory',
+                  help='the SAVE_DIRECTORY config [a temporary directory]')
+parser.add_option('--timeout', type='float', default=3600,
+                  help='the seconds to wait for builds [%default]')
+parser.add_option('-v', '--verbose', action='store_const', const=logging.INFO,
+                  dest='verbosity', default=logging.WARNING,
+                  help='enable additional output')
+
+
+def main(*args, **kwargs):
+    options, args = parser.parse_args(*args, **kwargs)
+    if args:
+        parser.error('too many arguments')
+    logging.basicConfig(level=options.verbosity)
+    save_dir = (options.save_directory or
+                tempfile.mkdtemp(prefix='okydoky-bench-'))
+    fake = FakeGitHub(SyntheticProject(options.pages, options.paragraphs))
+    sock = listen(('127.0.0.1', 0))
+    spawn_n(server, sock, fake, log=open(os.devnull, 'w'))
+    base_url = 'http://{0}:{1}'.format(*sock.getsockname())
+    app.config.update(
+        REPOSITORY=REPOSITORY,
+        CLIENT_ID='bench',
+        CLIENT_SECRET='bench',
+        SECRET_KEY='bench',
+        SAVE_DIRECTORY=save_dir,
+        ACCESS_TOKEN=TOKEN,
+        GITHUB_URL=base_url,
+        GITHUB_API_URL=base_url,
+        BUILD_POLICY=options.policy
+    )
+    print 'SAVE_DIRECTORY:', save_dir
+    start_workers(app.config)
+    client = app.test_client()
+    nonce = os.urandom(8).encode('hex')
+    commits = []
+    started_at = time.time()
+    for push in xrange(options.pushes):
+        if push and options.interval:
+            sleep(options.interval)
+        shas = [hashlib.sha1('{0}-{1}-{2}'.format(nonce, push, i))
+                       .hexdigest()
+                for i in xrange(options.commits)]
+        payload = make_payload(shas, datetime.datetime.utcnow())
+        client.post('/', data={'payload': json.dumps(payload)})
+        commits.extend(shas)
+    queue = get_build_queue(app.config)
+    while not is_idle(queue):
+        if time.time() - started_at > options.timeout:
+            print >> sys.stderr, 'timed out'
+            break
+        sleep(0.5)
+    elapsed = time.time() - started_at
+    index = get_build_index(app.config)
+    report(dict((sha, index.get(sha)) for sha in commits), elapsed, fake)
+
+
+if __name__ == '__main__':
+    main()
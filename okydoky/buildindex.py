@@ -0,0 +1,259 @@
+""":mod:`okydoky.buildindex` --- Persistent build index
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+The index of builds is an SQLite database in ``SAVE_DIRECTORY``, or in
+``INDEX_DIRECTORY`` if it's set.  It's updated when builds are published,
+so that listing builds and resolving short refs don't have to scan
+the directory.
+
+SQLite databases can be corrupted on NFS, whose locks are unreliable, so
+``INDEX_DIRECTORY`` has to be set to another filesystem if
+``SAVE_DIRECTORY`` is shared over NFS.
+
+"""
+import contextlib
+import logging
+import os
+import os.path
+import re
+import sqlite3
+import time
+
+from flask import json
+
+from .pack import PACK_SUFFIX, Pack
+from .store import get_size
+
+
+#: (:class:`str`) The filename of the database under ``SAVE_DIRECTORY``.
+INDEX_FILENAME = 'index.db'
+
+#: (:class:`str`) The format of timestamps.
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS builds (
+        sha TEXT PRIMARY KEY,
+        built_at REAL NOT NULL,
+        status TEXT NOT NULL,
+        has_log INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        accessed_at REAL,
+        timings TEXT
+    );
+    CREATE INDEX IF NOT EXISTS builds_built_at ON builds (built_at);
+'''
+
+#: (:class:`tuple`) Pairs of names and types of columns added after
+#: the first release of the schema.
+MIGRATIONS = (
+    ('accessed_at', 'REAL'),
+    ('timings', 'TEXT'),
+    ('fingerprint', 'TEXT'),
+    ('saved', 'INTEGER')
+)
+
+#: (:class:`str`) The columns which builds are made from.
+COLUMNS = 'sha, built_at, status, has_log, size, saved, timings'
+
+
+def get_index_dir(config):
+    """The directory which stores SQLite databases: ``INDEX_DIRECTORY``,
+    or ``SAVE_DIRECTORY`` if it's not set.
+
+    """
+    return config.get('INDEX_DIRECTORY') or config['SAVE_DIRECTORY']
+
+
+class BuildIndex(object):
+    """The index of builds in the ``SAVE_DIRECTORY``.  If the database
+    doesn't exist yet, it's made from existing builds.
+
+    Builds are represented as dictionaries which contain ``'sha'``,
+    ``'built_at'`` (formatted in :const:`TIME_FORMAT`), ``'status'``
+    (``'success'``, ``'failure'`` or ``'archived'``), ``'has_log'``,
+    ``'size'``, ``'saved'`` (the number of bytes saved by deduplication)
+    and ``'timings'`` (the dictionary of seconds spent in each phase of
+    the build).
+
+    :param config: the config dictionary
+
+    """
+
+    def __init__(self, config):
+        self.save_dir = config['SAVE_DIRECTORY']
+        if not os.path.isdir(self.save_dir):
+            os.makedirs(self.save_dir)
+        index_dir = get_index_dir(config)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self.path = os.path.join(index_dir, INDEX_FILENAME)
+        with self.connect() as db:
+            cursor = db.execute("SELECT count(*) FROM sqlite_master "
+                                "WHERE type = 'table' AND name = 'builds'")
+            exists = cursor.fetchone()[0]
+            db.executescript(SCHEMA)
+            columns = [row[1] for row in
+                       db.execute('PRAGMA table_info(builds)')]
+            for column, type_ in MIGRATIONS:
+                if column not in columns:
+                    db.execute('ALTER TABLE builds ADD COLUMN {0} {1}'.format(
+                        column, type_
+                    ))
+            db.execute('CREATE INDEX IF NOT EXISTS builds_fingerprint '
+                       'ON builds (fingerprint)')
+        if not exists:
+            self.rebuild()
+
+    @contextlib.contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _to_dict(self, row):
+        sha, built_at, status, has_log, size, saved, timings = row
+        return {
+            'sha': sha,
+            'built_at': time.strftime(TIME_FORMAT, time.gmtime(built_at)),
+            'status': status,
+            'has_log': bool(has_log),
+            'size': size,
+            'saved': saved or 0,
+            'timings': json.loads(timings) if timings else {}
+        }
+
+    def add(self, sha, status, has_log=False, size=0, built_at=None,
+            timings=None, fingerprint=None, saved=0):
+        """Adds the build of ``sha``, or replaces it if it already exists.
+        The ``fingerprint`` of its docs inputs can be recorded as well
+        (see :func:`~okydoky.incremental.get_fingerprint()`).
+
+        """
+        if built_at is None:
+            built_at = time.time()
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO builds '
+                       '(' + COLUMNS + ', fingerprint) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (sha.lower(), built_at, status, int(has_log), size,
+                        saved, json.dumps(timings) if timings else None,
+                        fingerprint))
+
+    def get(self, sha):
+        """Gets the build of ``sha``.  Returns ``None`` if there's no
+        such build.
+
+        """
+        with self.connect() as db:
+            row = db.execute('SELECT ' + COLUMNS + ' FROM builds '
+                             'WHERE sha = ?',
+                             (sha.lower(),)).fetchone()
+        return row and self._to_dict(row)
+
+    def resolve(self, prefix):
+        """Finds the successful build whose sha starts with ``prefix``,
+        using the primary key index.  Returns ``None`` if there's no
+        such build.
+
+        """
+        prefix = prefix.lower()
+        with self.connect() as db:
+            row = db.execute("SELECT sha FROM builds "
+                             "WHERE sha >= ? AND sha < ? AND "
+                             "status = 'success' ORDER BY sha LIMIT 1",
+                             (prefix, prefix + 'g')).fetchone()
+        return row and row[0]
+
+    def find_fingerprint(self, fingerprint):
+        """Lists shas of successful builds of the ``fingerprint``,
+        the most recent first.
+
+        """
+        with self.connect() as db:
+            rows = db.execute("SELECT sha FROM builds "
+                              "WHERE fingerprint = ? AND status = 'success' "
+                              "ORDER BY built_at DESC", (fingerprint,))
+            return [row[0] for row in rows]
+
+    def count(self):
+        """The number of builds."""
+        with self.connect() as db:
+            return db.execute('SELECT count(*) FROM builds').fetchone()[0]
+
+    def list(self, offset=0, limit=None):
+        """Lists builds, the most recent first."""
+        with self.connect() as db:
+            rows = db.execute('SELECT ' + COLUMNS + ' FROM builds '
+                              'ORDER BY built_at DESC LIMIT ? OFFSET ?',
+                              (-1 if limit is None else limit, offset))
+            return map(self._to_dict, rows)
+
+    def list_expired(self, keep, accessed_before):
+        """Lists builds which are neither one of ``keep`` most recent
+        successful builds nor built or accessed since ``accessed_before``,
+        the oldest first.  Archived builds aren't listed.
+
+        """
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT ' + COLUMNS + ' FROM builds '
+                "WHERE status != 'archived' AND "
+                'max(built_at, coalesce(accessed_at, 0)) < ? AND '
+                'sha NOT IN (SELECT sha FROM builds '
+                "            WHERE status = 'success' "
+                '            ORDER BY built_at DESC LIMIT ?) '
+                'ORDER BY built_at',
+                (accessed_before, keep)
+            )
+            return map(self._to_dict, rows)
+
+    def touch(self, sha, accessed_at=None):
+        """Records the build of ``sha`` was accessed."""
+        if accessed_at is None:
+            accessed_at = time.time()
+        with self.connect() as db:
+            db.execute('UPDATE builds SET accessed_at = ? WHERE sha = ?',
+                       (accessed_at, sha.lower()))
+
+    def set_status(self, sha, status):
+        with self.connect() as db:
+            db.execute('UPDATE builds SET status = ? WHERE sha = ?',
+                       (status, sha.lower()))
+
+    def remove(self, sha):
+        """Removes the build of ``sha`` from the index."""
+        with self.connect() as db:
+            db.execute('DELETE FROM builds WHERE sha = ?', (sha.lower(),))
+
+    def rebuild(self):
+        """Makes the index from builds in the ``SAVE_DIRECTORY``."""
+        logger = logging.getLogger(__name__ + '.BuildIndex.rebuild')
+        rows = []
+        for name in os.listdir(self.save_dir):
+            fullname = os.path.join(self.save_dir, name)
+            if re.match(r'^[A-Fa-f0-9]{40}$', name):
+                has_log = os.path.isfile(os.path.join(fullname, 'build.txt'))
+                size = get_size(fullname)
+            elif re.match(r'^[A-Fa-f0-9]{40}' + re.escape(PACK_SUFFIX) + '$',
+                          name):
+                try:
+                    pack = Pack(fullname)
+                except (IOError, ValueError):
+                    logger.exception('failed to read the pack %s', fullname)
+                    continue
+                has_log = pack.find('build.txt') is not None
+                pack.close()
+                size = os.path.getsize(fullname)
+            else:
+                continue
+            rows.append((name[:40].lower(), os.stat(fullname).st_mtime,
+                         'success', int(has_log), size, 0, None))
+        with self.connect() as db:
+            db.executemany('INSERT OR REPLACE INTO builds '
+                           '(' + COLUMNS + ') VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           rows)
+        logger.info('indexed %d builds in %s', len(rows), self.save_dir)
@@ -0,0 +1,73 @@
+""":mod:`okydoky.buildlog` --- Streamed build logs
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Output of build commands is written into ``_logs/<sha>.txt`` under
+``SAVE_DIRECTORY`` while the build runs, instead of being kept in memory.
+Failed builds leave their logs as well, and running builds can be watched
+through ``/<sha>/_log``.
+
+"""
+import errno
+import os
+import os.path
+
+from eventlet import sleep
+
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores build logs.
+LOGS_DIRNAME = '_logs'
+
+#: (:class:`int`) The seconds to wait for new output of running builds.
+TAIL_INTERVAL = 1
+
+#: (:class:`int`) The number of bytes to read from logs at once.
+CHUNK_SIZE = 65536
+
+
+def get_log_path(commit, config):
+    return os.path.join(config['SAVE_DIRECTORY'], LOGS_DIRNAME,
+                        commit + '.txt')
+
+
+def open_log(commit, config):
+    """Opens the log of the ``commit`` to write.  The old log of
+    the commit, if any, is truncated.
+
+    """
+    filename = get_log_path(commit, config)
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return open(filename, 'w')
+
+
+def remove_log(commit, config):
+    try:
+        os.unlink(get_log_path(commit, config))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def tail(filename, is_running, interval=TAIL_INTERVAL):
+    """Yields the content of the log ``filename`` in chunks, and then
+    output appended to it until ``is_running()`` returns ``False``.
+
+    """
+    with open(filename, 'rb') as f:
+        while 1:
+            chunk = f.read(CHUNK_SIZE)
+            if chunk:
+                yield chunk
+            elif is_running():
+                sleep(interval)
+            else:
+                # Output written right before the build finished.
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    yield chunk
+                break
@@ -0,0 +1,324 @@
+""":mod:`okydoky.buildqueue` --- Durable build queue
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Build jobs are stored as JSON files in the ``_queue`` directory under
+``SAVE_DIRECTORY``, one file per commit, so that they're unique by commit id
+and survive restarts.  A worker claims a job by renaming its file, which is
+atomic.
+
+Claimed jobs are leased to the process which claimed them.  The process
+renews its leases every :const:`HEARTBEAT_INTERVAL` seconds, and jobs whose
+leases have expired, e.g. because their worker died, are made pending
+again, so that several build workers can share the queue.  Updates of
+the queue are serialized by a :class:`~okydoky.cluster.FileLock`.
+
+"""
+import errno
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from flask import json
+
+from .cluster import FileLock, get_node_name, is_alive
+
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores the queue.
+QUEUE_DIRNAME = '_queue'
+
+#: (:class:`int`) The seconds between renewals of leases of claimed jobs.
+HEARTBEAT_INTERVAL = 15
+
+#: (:class:`int`) The seconds after which leases which haven't been
+#: renewed expire.
+LEASE_TIMEOUT = 60
+
+#: (:class:`int`) The priority of jobs which build the newest commit of
+#: a push.  Lower is prior.
+HEAD_PRIORITY = 0
+
+#: (:class:`int`) The priority of jobs which backfill older commits.
+BACKFILL_PRIORITY = 1
+
+
+class BuildQueue(object):
+    """The durable build queue of the ``SAVE_DIRECTORY``.
+
+    Each job is a dictionary which contains the following keys:
+
+    ``'commit'``
+       The commit id to build.
+    ``'permalink'``
+       The permalink of the docs.
+    ``'push'``
+       The serial number of the push which the commit came from.
+    ``'rank'``
+       The position of the commit in the push.  0 is the newest.
+    ``'priority'``
+       :const:`HEAD_PRIORITY` or :const:`BACKFILL_PRIORITY`.
+    ``'enqueued_at'``
+       The timestamp when the job was enqueued.
+    ``'owner'``
+       The node name and the process id which claimed the job.  Only
+       claimed jobs have it.
+
+    :param config: the config dictionary
+
+    """
+
+    def __init__(self, config):
+        self.path = os.path.join(config['SAVE_DIRECTORY'], QUEUE_DIRNAME)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.lock = FileLock(os.path.join(self.path, '.lock'))
+        self.owner = {'node': get_node_name(config), 'pid': os.getpid()}
+        #: (:class:`set`) Commits of jobs claimed by this process.
+        self.claimed = set()
+
+    def _read(self, filename):
+        try:
+            with open(os.path.join(self.path, filename)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, filename, data):
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, os.path.join(self.path, filename))
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(os.path.join(self.path, filename))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def current_push(self):
+        """The serial number of the latest push."""
+        return self._read('push.json') or 0
+
+    def push(self, commits, policy='all'):
+        """Enqueues ``commits`` of a new push.  The first one becomes
+        a head job and the rest become backfill jobs.  Pending jobs of
+        older pushes are demoted to backfill jobs, or dropped if
+        ``policy`` is ``'latest'``.  A push without commits does nothing.
+
+        :param commits: the list of pairs of commit id and permalink,
+                        the newest first
+        :param policy: the ``BUILD_POLICY``
+        :returns: the list of enqueued jobs
+
+        """
+        logger = logging.getLogger(__name__ + '.BuildQueue.push')
+        if not commits:
+            return []
+        with self.lock:
+            push = self.current_push() + 1
+            self._write('push.json', push)
+            for job in self.pending():
+                if policy == 'latest':
+                    logger.info('superseded by a newer push; cancel %s',
+                                job['commit'])
+                    self._unlink(job['commit'] + '.json')
+                elif job['priority'] != BACKFILL_PRIORITY:
+                    job['priority'] = BACKFILL_PRIORITY
+                    self._write(job['commit'] + '.json', job)
+            jobs = []
+            now = time.time()
+            for rank, (commit, permalink) in enumerate(commits):
+                priority = BACKFILL_PRIORITY if rank else HEAD_PRIORITY
+                running = self._read(commit + '.running')
+                if running is not None:
+                    # The running job is stamped with this push, so that
+                    # it can become the head when it's built.
+                    logger.info('%s is already being built; skip...', commit)
+                    running.update(push=push, rank=rank, priority=priority)
+                    self._write(commit + '.running', running)
+                    continue
+                job = {
+                    'commit': commit,
+                    'permalink': permalink,
+                    'push': push,
+                    'rank': rank,
+                    'priority': priority,
+                    'enqueued_at': now
+                }
+                self._write(commit + '.json', job)
+                jobs.append(job)
+            logger.info('enqueued %d jobs of the push %d', len(jobs), push)
+        return jobs
+
+    def pending(self):
+        """The list of pending jobs in the order they'll be claimed."""
+        jobs = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json') and not name.startswith(('.', 'push.',
+                                                               'head.')):
+                job = self._read(name)
+                if job is not None:
+                    jobs.append(job)
+        jobs.sort(key=lambda job: (job['priority'], -job['push'], job['rank']))
+        return jobs
+
+    def running(self):
+        """The list of claimed jobs which are being built."""
+        jobs = []
+        for name in os.listdir(self.path):
+            if name.endswith('.running'):
+                job = self._read(name)
+                if job is not None:
+                    jobs.append(job)
+        jobs.sort(key=lambda job: (job['priority'], -job['push'], job['rank']))
+        return jobs
+
+    def is_running(self, commit):
+        """Whether the job of ``commit`` is being built."""
+        return os.path.isfile(os.path.join(self.path, commit + '.running'))
+
+    def is_cancelled(self, commit):
+        """Whether the running job of ``commit`` has been cancelled."""
+        return os.path.isfile(os.path.join(self.path, commit + '.cancel'))
+
+    def cancel(self, commit):
+        """Cancels the job of ``commit``.  A pending job is removed from
+        the queue, and a running job is marked as cancelled so that
+        the worker kills its build.
+
+        :returns: ``'pending'`` or ``'running'`` which was the state of
+                  the job, or ``None`` if there's no such job
+        :rtype: :class:`str`
+
+        """
+        with self.lock:
+            try:
+                os.unlink(os.path.join(self.path, commit + '.json'))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                return 'pending'
+            if self.is_running(commit):
+                self._write(commit + '.cancel',
+                            {'cancelled_at': time.time()})
+                return 'running'
+
+    def claim(self):
+        """Claims the most prior pending job.  Returns ``None`` if there's
+        no pending job.
+
+        """
+        with self.lock:
+            for job in self.pending():
+                commit = job['commit']
+                try:
+                    os.rename(os.path.join(self.path, commit + '.json'),
+                              os.path.join(self.path, commit + '.running'))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                job['owner'] = self.owner
+                self._write(commit + '.running', job)
+                self.claimed.add(commit)
+                return job
+
+    def complete(self, job):
+        """Removes the claimed ``job`` from the queue unless its lease has
+        been taken by another process.
+
+        """
+        commit = job['commit']
+        with self.lock:
+            self.claimed.discard(commit)
+            running = self._read(commit + '.running')
+            if running is not None and running.get('owner') == self.owner:
+                self._unlink(commit + '.running')
+                self._unlink(commit + '.cancel')
+
+    def heartbeat(self):
+        """Renews leases of jobs claimed by this process."""
+        for commit in list(self.claimed):
+            try:
+                os.utime(os.path.join(self.path, commit + '.running'), None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def is_expired(self, commit):
+        """Tests whether the lease of the claimed job of ``commit`` has
+        expired.  Leases of processes which have gone on this node expire
+        immediately.
+
+        """
+        if commit in self.claimed:
+            return False
+        filename = os.path.join(self.path, commit + '.running')
+        job = self._read(commit + '.running')
+        owner = job and job.get('owner')
+        if owner is not None and owner['node'] == self.owner['node']:
+            # The process id of this process is reused from the last run.
+            return (owner['pid'] == self.owner['pid'] or
+                    not is_alive(owner['pid']))
+        try:
+            renewed_at = os.stat(filename).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return time.time() - renewed_at > LEASE_TIMEOUT
+
+    def recover(self):
+        """Makes jobs whose leases have expired, e.g. jobs interrupted by
+        a restart, pending again, except cancelled ones.  Returns
+        the number of recovered jobs.
+
+        """
+        logger = logging.getLogger(__name__ + '.BuildQueue.recover')
+        count = 0
+        with self.lock:
+            for name in os.listdir(self.path):
+                if not name.endswith('.running'):
+                    continue
+                commit = name[:-len('.running')]
+                if not self.is_expired(commit):
+                    continue
+                elif self.is_cancelled(commit):
+                    self._unlink(name)
+                    self._unlink(commit + '.cancel')
+                    logger.info('drop the cancelled job %s', commit)
+                elif os.path.isfile(os.path.join(self.path, commit + '.json')):
+                    self._unlink(name)
+                else:
+                    os.rename(os.path.join(self.path, name),
+                              os.path.join(self.path, commit + '.json'))
+                    logger.info('resume the interrupted job %s', commit)
+                    count += 1
+        return count
+
+    def promote(self, job):
+        """Tests whether the built ``job`` should become the new head,
+        and records it if so.  Only the newest built commit of the latest
+        push can become the head.  The job may have been stamped with
+        a newer push while it was being built.
+
+        """
+        with self.lock:
+            running = self._read(job['commit'] + '.running')
+            if running is not None:
+                for key in 'push', 'rank', 'priority':
+                    job[key] = running[key]
+            if job['push'] != self.current_push():
+                return False
+            head = self._read('head.json')
+            if (head is not None and head['push'] == job['push'] and
+                    head['rank'] <= job['rank']):
+                return False
+            self._write('head.json', {'push': job['push'],
+                                      'rank': job['rank'],
+                                      'commit': job['commit']})
+            return True
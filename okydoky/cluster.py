@@ -0,0 +1,107 @@
+""":mod:`okydoky.cluster` --- Coordination of nodes
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Several web servers and build workers, on the same host or on different
+nodes, can share a ``SAVE_DIRECTORY`` e.g. over NFS.  They coordinate
+through files in it: jobs are claimed with leases which build workers
+renew (see :class:`~okydoky.buildqueue.BuildQueue`), and read-modify-write
+updates are serialized with :class:`FileLock`.
+
+"""
+import errno
+import os
+import socket
+
+from eventlet import sleep
+from eventlet.semaphore import Semaphore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+#: (:class:`float`) The seconds between attempts to take a lock which is
+#: held by another process.
+LOCK_POLL_INTERVAL = 0.05
+
+#: (:class:`dict`) The semaphore of each lock file, which serializes
+#: green threads of this process since POSIX locks are per process.
+semaphores = {}
+
+
+def get_node_name(config):
+    """The name of this node.  It's ``NODE_NAME`` config or the hostname."""
+    return config.get('NODE_NAME') or socket.gethostname()
+
+
+def is_alive(pid):
+    """Tests whether the process of ``pid`` on this node is alive."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class FileLock(object):
+    """The exclusive lock of the file ``path``, which is made if it doesn't
+    exist.  POSIX record locks (:func:`fcntl.lockf()`) are used, so that
+    they work across processes and across nodes over NFS.  Waiting for
+    the lock doesn't block other green threads.
+
+    It can be used as a context manager as well::
+
+        with FileLock(path):
+            ...
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.semaphore = semaphores.setdefault(path, Semaphore())
+        self.file = None
+
+    def acquire(self, blocking=True):
+        """Takes the lock.  Returns ``False`` if it's held by others and
+        ``blocking`` is ``False``.
+
+        """
+        if not self.semaphore.acquire(blocking):
+            return False
+        try:
+            f = open(self.path, 'a')
+        except Exception:
+            self.semaphore.release()
+            raise
+        while fcntl is not None:
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EACCES, errno.EAGAIN) and blocking:
+                    sleep(LOCK_POLL_INTERVAL)
+                    continue
+                f.close()
+                self.semaphore.release()
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    return False
+                raise
+            break
+        self.file = f
+        return True
+
+    def release(self):
+        f, self.file = self.file, None
+        try:
+            if fcntl is not None:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+            f.close()
+        finally:
+            self.semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,122 @@
+""":mod:`okydoky.compress` --- Precompression of built docs
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Built docs are compressed once when they're published, so that serving
+them costs no compression.  Every compressible file gets a ``.gz`` sibling,
+and a ``.br`` sibling as well if brotli_ is installed.  CSS and JavaScript
+files are minified first if rcssmin_ and rjsmin_ are installed.
+
+.. _brotli: https://pypi.python.org/pypi/Brotli
+.. _rcssmin: https://pypi.python.org/pypi/rcssmin
+.. _rjsmin: https://pypi.python.org/pypi/rjsmin
+
+"""
+import gzip
+import logging
+import os
+import os.path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+#: (:class:`tuple`) The extensions of compressible files.
+COMPRESSIBLE_EXTENSIONS = ('.html', '.css', '.js', '.json', '.svg', '.txt',
+                           '.xml')
+
+#: (:class:`int`) Files smaller than this aren't compressed.
+MIN_SIZE = 256
+
+#: (:class:`tuple`) Pairs of content encodings and suffixes of compressed
+#: siblings, the preferred first.
+ENCODINGS = ('br', '.br'), ('gzip', '.gz')
+
+
+def is_compressible(filename):
+    return os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def minify(filename):
+    """Minifies the CSS or JavaScript file in place if possible."""
+    ext = os.path.splitext(filename)[1].lower()
+    if filename.endswith(('.min.js', '.min.css')):
+        return
+    elif ext == '.css' and rcssmin is not None:
+        function = rcssmin.cssmin
+    elif ext == '.js' and rjsmin is not None:
+        function = rjsmin.jsmin
+    else:
+        return
+    with open(filename, 'rb') as f:
+        content = f.read()
+    minified = function(content)
+    if len(minified) < len(content):
+        with open(filename, 'wb') as f:
+            f.write(minified)
+
+
+def compress_file(filename):
+    """Writes compressed siblings of the file.  Siblings which aren't
+    smaller than the original aren't written.
+
+    :returns: the number of bytes saved by gzip
+    :rtype: :class:`int`
+
+    """
+    with open(filename, 'rb') as f:
+        content = f.read()
+    saved = 0
+    gz_filename = filename + '.gz'
+    # Neither the filename nor the mtime goes into the gzip header, so that
+    # the same content is always compressed into the same bytes, which
+    # okydoky.store can deduplicate.
+    with open(gz_filename, 'wb') as f:
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0)
+        gz.write(content)
+        gz.close()
+        size = f.tell()
+    if size < len(content):
+        saved = len(content) - size
+    else:
+        os.unlink(gz_filename)
+    if brotli is not None:
+        compressed = brotli.compress(content)
+        if len(compressed) < len(content):
+            with open(filename + '.br', 'wb') as f:
+                f.write(compressed)
+    return saved
+
+
+def compress_build(build, config):
+    """Minifies and precompresses the built docs in ``build``, unless
+    ``MINIFY_ASSETS`` or ``PRECOMPRESS`` is turned off.
+
+    """
+    logger = logging.getLogger(__name__ + '.compress_build')
+    minify_assets = config.get('MINIFY_ASSETS', True)
+    precompress = config.get('PRECOMPRESS', True)
+    if not (minify_assets or precompress):
+        return
+    count = saved = 0
+    for dirpath, _, filenames in os.walk(build):
+        for filename in filenames:
+            fullname = os.path.join(dirpath, filename)
+            if os.path.islink(fullname) or not is_compressible(filename):
+                continue
+            if minify_assets:
+                minify(fullname)
+            if precompress and os.path.getsize(fullname) >= MIN_SIZE:
+                saved += compress_file(fullname)
+                count += 1
+    logger.info('compressed %d files in %s; %d bytes saved by gzip',
+                count, build, saved)
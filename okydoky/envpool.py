@@ -0,0 +1,228 @@
+""":mod:`okydoky.envpool` --- Pool of virtualenvs
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Virtualenvs are kept in the ``_envs`` directory under ``SAVE_DIRECTORY``,
+keyed by the fingerprint of the project's declared dependencies and the
+shared Sphinx virtualenv.  A commit whose dependencies haven't changed
+reuses a warm virtualenv and skips installing dependencies.
+
+Sphinx isn't installed into each virtualenv.  It's installed once into
+the virtualenv in the ``_sphinx`` directory, keyed only by the Python
+version and the Sphinx requirement, and shared by virtualenvs of all
+repositories through a ``.pth`` file.  Packages of the shared virtualenv
+come after the project's own ones, so the project's dependencies take
+precedence.
+
+Each virtualenv is leased by one build at a time, even across processes
+sharing the ``SAVE_DIRECTORY``.  If all virtualenvs of a key are leased,
+another one is made for the key.  Least recently used
+virtualenvs are evicted when there are more than ``MAX_VIRTUALENVS``.
+
+"""
+import glob
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import sys
+
+import pkg_resources
+from eventlet import tpool
+from virtualenv import create_environment, path_locations, virtualenv_version
+
+from .cluster import FileLock
+
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores virtualenvs.
+ENVS_DIRNAME = '_envs'
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores virtualenvs having Sphinx installed.
+SPHINX_ENVS_DIRNAME = '_sphinx'
+
+#: (:class:`str`) The name of the file which exposes the shared Sphinx
+#: virtualenv to a virtualenv of the pool.
+SPHINX_PTH_FILENAME = 'okydoky-sphinx.pth'
+
+#: (:class:`str`) The name of the file which marks a virtualenv
+#: has all dependencies installed.
+READY_FILENAME = '.okydoky-ready'
+
+#: (:class:`tuple`) Glob patterns of files which declare dependencies.
+DEPENDENCY_FILES = 'setup.py', 'setup.cfg', 'requirements*.txt'
+
+#: (:class:`str`) The requirement of Sphinx to install.
+SPHINX_REQUIREMENT = 'Sphinx'
+
+
+def get_env_key(path, config):
+    """Gets the fingerprint of dependencies of the project extracted to
+    ``path``.
+
+    """
+    # Dependencies which the shared Sphinx virtualenv already has aren't
+    # installed again, so the virtualenv is valid only with the same one.
+    digest = hashlib.sha1(get_sphinx_env_key() + '\0')
+    for pattern in DEPENDENCY_FILES:
+        for filename in sorted(glob.glob(os.path.join(path, pattern))):
+            digest.update(os.path.basename(filename) + '\0')
+            with open(filename, 'rb') as f:
+                digest.update(f.read())
+            digest.update('\0')
+    return digest.hexdigest()
+
+
+def get_sphinx_env_key():
+    """Gets the fingerprint of the shared Sphinx virtualenv, which doesn't
+    depend on projects.
+
+    """
+    digest = hashlib.sha1(sys.version)
+    digest.update('\0' + SPHINX_REQUIREMENT)
+    return digest.hexdigest()
+
+
+def get_site_packages(envdir):
+    """Gets the path of the ``site-packages`` directory of the virtualenv
+    ``envdir``.
+
+    """
+    lib_dir = path_locations(envdir)[1]
+    return os.path.join(lib_dir, 'site-packages')
+
+
+def link_sphinx_env(envdir, sphinx_env):
+    """Exposes packages of the shared Sphinx virtualenv ``sphinx_env`` to
+    the virtualenv ``envdir``.
+
+    """
+    # Lines starting with import are executed, and addsitedir() processes
+    # .pth files of the shared virtualenv, e.g., eggs listed in its
+    # easy-install.pth, as well.
+    line = 'import site; site.addsitedir({0!r})\n'.format(
+        get_site_packages(sphinx_env)
+    )
+    pth = os.path.join(get_site_packages(envdir), SPHINX_PTH_FILENAME)
+    with open(pth, 'w') as f:
+        f.write(line)
+
+
+def create_virtualenv(envdir):
+    logger = logging.getLogger(__name__ + '.create_virtualenv')
+    logger.info('creating new virtualenv: %s' % envdir)
+    if (pkg_resources.parse_version(virtualenv_version) <
+            pkg_resources.parse_version('1.10.1')):
+        create_environment(envdir, use_distribute=True)
+    else:
+        create_environment(envdir)
+    logger.info('created virtualenv: %s' % envdir)
+
+
+class VirtualenvPool(object):
+    """The pool of virtualenvs in the ``SAVE_DIRECTORY``.
+
+    :param config: the config dictionary
+
+    """
+
+    def __init__(self, config):
+        self.path = os.path.join(config['SAVE_DIRECTORY'], ENVS_DIRNAME)
+        self.sphinx_path = os.path.join(config['SAVE_DIRECTORY'],
+                                        SPHINX_ENVS_DIRNAME)
+        self.size = config.get('MAX_VIRTUALENVS', 4)
+        #: (:class:`dict`) The :class:`~okydoky.cluster.FileLock` of each
+        #: virtualenv leased by this process.
+        self.leases = {}
+        for path in self.path, self.sphinx_path:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def acquire(self, key, recreate=False):
+        """Leases a virtualenv for ``key``.  It's made if there's no
+        idle one.
+
+        :param key: the key :func:`get_env_key()` returns
+        :param recreate: makes a new virtualenv even if there's a warm one
+        :returns: a pair of the path of the virtualenv and whether it's
+                  warm, i.e., it has all dependencies installed
+        :rtype: :class:`tuple`
+
+        """
+        logger = logging.getLogger(__name__ + '.VirtualenvPool.acquire')
+        # Making virtualenvs blocks, so it's done in a thread not to stall
+        # other green threads, e.g., renewals of leases.
+        n = 0
+        while 1:
+            envdir = os.path.join(self.path, '{0}.{1}'.format(key, n))
+            if envdir not in self.leases:
+                lock = FileLock(envdir + '.lock')
+                if lock.acquire(blocking=False):
+                    break
+            n += 1
+        self.leases[envdir] = lock
+        try:
+            warm = not recreate and self.is_ready(envdir)
+            if warm:
+                logger.info('reuse the warm virtualenv %s', envdir)
+                os.utime(envdir, None)
+            else:
+                if os.path.isdir(envdir):
+                    tpool.execute(shutil.rmtree, envdir)
+                self.evict()
+                tpool.execute(create_virtualenv, envdir)
+        except Exception:
+            self.release(envdir)
+            raise
+        return envdir, warm
+
+    def is_ready(self, envdir):
+        """Whether the virtualenv has all dependencies installed."""
+        return os.path.isfile(os.path.join(envdir, READY_FILENAME))
+
+    def mark_ready(self, envdir):
+        """Marks the virtualenv has all dependencies installed."""
+        with open(os.path.join(envdir, READY_FILENAME), 'w'):
+            pass
+
+    def get_sphinx_env(self):
+        """The path of the shared Sphinx virtualenv.  It might not be
+        made yet.
+
+        """
+        return os.path.join(self.sphinx_path, get_sphinx_env_key())
+
+    def release(self, envdir):
+        """Returns the leased virtualenv to the pool."""
+        lock = self.leases.pop(envdir, None)
+        if lock is not None:
+            lock.release()
+
+    def evict(self):
+        """Removes least recently used idle virtualenvs so that there's
+        room for a new one.
+
+        """
+        logger = logging.getLogger(__name__ + '.VirtualenvPool.evict')
+        envs = []
+        for name in os.listdir(self.path):
+            envdir = os.path.join(self.path, name)
+            if os.path.isdir(envdir):
+                envs.append((os.stat(envdir).st_mtime, envdir))
+        envs.sort()
+        excess = len(envs) - self.size + 1
+        for _, envdir in envs:
+            if excess <= 0:
+                break
+            elif envdir in self.leases:
+                continue
+            lock = FileLock(envdir + '.lock')
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                tpool.execute(shutil.rmtree, envdir, ignore_errors=True)
+            finally:
+                lock.release()
+            logger.info('evicted the virtualenv %s', envdir)
+            excess -= 1
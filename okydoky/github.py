@@ -0,0 +1,290 @@
+""":mod:`okydoky.github` --- GitHub client
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A small HTTP client for GitHub.  It keeps connections alive and reuses them,
+revalidates repeated API reads with ``If-None-Match`` (which don't count
+against the rate limit), and slows requests down before the rate limit is
+exhausted.
+
+"""
+import collections
+import functools
+import hashlib
+import logging
+import socket
+import StringIO
+import time
+import urlparse
+
+from eventlet import sleep
+from eventlet.green import httplib
+from flask import json
+
+from .metrics import GITHUB_REQUESTS
+from .version import VERSION
+
+
+#: (:class:`str`) The ``User-Agent`` header which GitHub requires.
+USER_AGENT = 'Okydoky/' + VERSION
+
+#: (:class:`tuple`) The status codes of redirections to follow.
+REDIRECT_STATUSES = 301, 302, 303, 307, 308
+
+#: (:class:`str`) The default base URL of GitHub.  It can be overridden by
+#: ``GITHUB_URL`` config e.g. for a fake GitHub.
+GITHUB_URL = 'https://github.com'
+
+#: (:class:`str`) The default base URL of the GitHub API.  It can be
+#: overridden by ``GITHUB_API_URL`` config.
+GITHUB_API_URL = 'https://api.github.com'
+
+
+def get_url(path, config):
+    """Makes the URL of ``path`` on GitHub."""
+    return config.get('GITHUB_URL', GITHUB_URL).rstrip('/') + path
+
+
+def get_api_url(path, config):
+    """Makes the URL of ``path`` on the GitHub API."""
+    return config.get('GITHUB_API_URL', GITHUB_API_URL).rstrip('/') + path
+
+
+class HTTPError(IOError):
+    """Raised when GitHub responds with an error status."""
+
+    def __init__(self, url, code, body, headers=None):
+        super(HTTPError, self).__init__(
+            '{0} responded {1}: {2}'.format(url, code, body[:200])
+        )
+        self.url = url
+        self.code = code
+        self.body = body
+        #: (:class:`dict`) Headers.  Names are lowercased.
+        self.headers = headers or {}
+
+    def is_rate_limited(self):
+        """Whether GitHub refused the request because of its rate limit.
+        It answers 403 for it as well as for forbidden resources.
+
+        """
+        if self.code == 429:
+            return True
+        return self.code == 403 and (
+            self.headers.get('x-ratelimit-remaining') == '0' or
+            'rate limit' in self.body.lower()
+        )
+
+
+class Response(object):
+    """The response of :meth:`GitHubClient.request()`.  Unbuffered
+    responses have to be closed after reading.
+
+    """
+
+    def __init__(self, url, status, headers, fp, release=None):
+        self.url = url
+        self.status = status
+        #: (:class:`dict`) Headers.  Names are lowercased.
+        self.headers = headers
+        self.fp = fp
+        self._release = release
+
+    def read(self, amt=None):
+        return self.fp.read() if amt is None else self.fp.read(amt)
+
+    def json(self):
+        return json.loads(self.read())
+
+    def close(self):
+        if self._release is not None:
+            self._release()
+            self._release = None
+
+
+class RateLimiter(object):
+    """The token bucket which follows ``X-RateLimit-*`` headers of GitHub.
+    Requests burst freely while the remaining quota is more than
+    ``reserve`` of the limit, and then they're spread evenly over the rest
+    of the rate limit window.
+
+    :param reserve: the ratio of the quota to spread
+    :type reserve: :class:`float`
+
+    """
+
+    def __init__(self, reserve=0.2):
+        self.reserve = reserve
+        self.limit = self.remaining = self.reset = None
+        self.next_at = 0
+
+    def acquire(self):
+        """Waits until a request can be sent."""
+        logger = logging.getLogger(__name__ + '.RateLimiter.acquire')
+        now = time.time()
+        if self.remaining is None or now >= self.reset:
+            return
+        elif self.remaining <= 0:
+            logger.warning('rate limit exceeded; wait %d seconds',
+                           self.reset - now)
+            sleep(self.reset - now)
+            return
+        elif self.remaining > self.limit * self.reserve:
+            self.remaining -= 1
+            return
+        interval = (self.reset - now) / self.remaining
+        wait = self.next_at - now
+        if wait > 0:
+            logger.info('%d requests remain; wait %.1f seconds',
+                        self.remaining, wait)
+            sleep(wait)
+            now = time.time()
+        self.next_at = now + interval
+        self.remaining -= 1
+
+    def update(self, headers):
+        """Updates the bucket from response ``headers``."""
+        try:
+            limit = int(headers['x-ratelimit-limit'])
+            remaining = int(headers['x-ratelimit-remaining'])
+            reset = int(headers['x-ratelimit-reset'])
+        except (KeyError, ValueError):
+            return
+        self.limit, self.remaining, self.reset = limit, remaining, reset
+
+
+class GitHubClient(object):
+    """The HTTP client for GitHub.
+
+    :param max_idle: the maximum number of idle connections to keep
+                     for each host
+    :param etag_cache_size: the maximum number of responses to revalidate
+    :param timeout: the socket timeout in seconds
+
+    """
+
+    def __init__(self, max_idle=4, etag_cache_size=256, timeout=60):
+        self.max_idle = max_idle
+        self.etag_cache_size = etag_cache_size
+        self.timeout = timeout
+        self.idle = collections.defaultdict(list)
+        self.etags = collections.OrderedDict()
+        self.limiters = collections.defaultdict(RateLimiter)
+
+    def _acquire(self, key):
+        try:
+            return self.idle[key].pop(), True
+        except IndexError:
+            pass
+        scheme, netloc = key
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        return cls(netloc, timeout=self.timeout), False
+
+    def _release(self, key, connection, response):
+        if (response.isclosed() and not response.will_close and
+                len(self.idle[key]) < self.max_idle):
+            self.idle[key].append(connection)
+        else:
+            connection.close()
+
+    def _send(self, key, method, selector, body, headers):
+        while 1:
+            connection, reused = self._acquire(key)
+            try:
+                connection.request(method, selector, body, headers)
+                return connection, connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # A kept-alive connection might have been closed by
+                # the server; retry with another one.
+                if not reused:
+                    raise
+
+    def request(self, method, url, body=None, headers=None, token=None,
+                buffered=True, max_redirects=5):
+        """Sends a request and returns its :class:`Response`.  Redirections
+        are followed, and the access ``token`` isn't sent to other hosts.
+
+        :param token: the access token to authorize the request
+        :param buffered: reads the whole content at once.  buffered ``GET``
+                         responses with ``ETag`` are revalidated next time.
+                         unbuffered responses have to be closed
+        :raises HTTPError: when the response status is 400 or higher
+
+        """
+        logger = logging.getLogger(__name__ + '.GitHubClient.request')
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+        if token:
+            headers['Authorization'] = 'token ' + token
+        for _ in xrange(max_redirects + 1):
+            scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+            selector = path + ('?' + query if query else '')
+            key = scheme, netloc
+            cache_key = cached = None
+            headers.pop('If-None-Match', None)
+            if method == 'GET' and buffered:
+                cache_key = url, headers.get('Authorization')
+                cached = self.etags.get(cache_key)
+                if cached is not None:
+                    headers['If-None-Match'] = cached[0]
+            limiter = None
+            if 'Authorization' in headers:
+                limiter = self.limiters[
+                    hashlib.sha1(headers['Authorization']).hexdigest()
+                ]
+                limiter.acquire()
+            logger.debug('%s %s', method, url)
+            connection, response = self._send(key, method, selector, body,
+                                              headers)
+            release = functools.partial(self._release,
+                                        key, connection, response)
+            response_headers = dict(response.getheaders())
+            if limiter is not None:
+                limiter.update(response_headers)
+            status = response.status
+            GITHUB_REQUESTS.inc(method=method, status=str(status))
+            if (status in REDIRECT_STATUSES and
+                    'location' in response_headers):
+                response.read()
+                release()
+                location = urlparse.urljoin(url,
+                                            response_headers['location'])
+                if urlparse.urlsplit(location)[:2] != key:
+                    headers.pop('Authorization', None)
+                if status == 303:
+                    method, body = 'GET', None
+                url = location
+                continue
+            elif status == 304 and cached is not None:
+                response.read()
+                release()
+                self.etags[cache_key] = self.etags.pop(cache_key)
+                logger.debug('%s is not modified', url)
+                _, status, response_headers, content = cached
+                return Response(url, status, response_headers,
+                                StringIO.StringIO(content))
+            elif status >= 400:
+                content = response.read()
+                release()
+                raise HTTPError(url, status, content, response_headers)
+            elif not buffered:
+                return Response(url, status, response_headers, response,
+                                release=release)
+            content = response.read()
+            release()
+            if cache_key is not None and 'etag' in response_headers:
+                self.etags.pop(cache_key, None)
+                self.etags[cache_key] = (response_headers['etag'], status,
+                                         response_headers, content)
+                while len(self.etags) > self.etag_cache_size:
+                    self.etags.popitem(last=False)
+            return Response(url, status, response_headers,
+                            StringIO.StringIO(content))
+        raise HTTPError(url, status, 'too many redirections')
+
+
+#: (:class:`GitHubClient`) The client shared by Okydoky.
+client = GitHubClient()
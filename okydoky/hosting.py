@@ -0,0 +1,137 @@
+""":mod:`okydoky.hosting` --- Multi-repository hosting
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+If ``REPOSITORIES`` is set, a single Okydoky instance hosts docs of several
+repositories under ``/<owner>/<repo>/``.  Each repository has its own
+subdirectory of ``SAVE_DIRECTORY``, and its config falls back to the root
+config, so only differences have to be configured::
+
+    REPOSITORIES = {
+        'crosspop/okydoky': {},
+        'crosspop/another': {'BUILD_POLICY': 'latest'}
+    }
+
+The build worker, the pool of virtualenvs, the access token and the OAuth
+callback (``/auth/finalize``) are shared by all repositories.
+
+"""
+import collections
+import os.path
+
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import redirect
+
+
+#: (:class:`str`) The WSGI environment key of the config of the repository
+#: which the request is for.
+CONFIG_ENVIRON_KEY = 'okydoky.config'
+
+#: (:class:`str`) The WSGI environment key of the original ``SCRIPT_NAME``,
+#: i.e., the root of all repositories.
+SCRIPT_ROOT_ENVIRON_KEY = 'okydoky.script_root'
+
+#: (:class:`frozenset`) Paths which are served at the root.
+ROOT_PATHS = frozenset(['/', '/auth', '/auth/finalize', '/metrics'])
+
+
+class RepositoryConfig(dict):
+    """The config of a hosted repository.  Keys which aren't set fall back
+    to the ``parent`` config.
+
+    :param parent: the root config
+    :param repository: the user and repository name
+    :param overrides: the dictionary of configs specific to the repository
+
+    """
+
+    def __init__(self, parent, repository, overrides=None):
+        super(RepositoryConfig, self).__init__(overrides or {})
+        self.parent = parent
+        self.setdefault('REPOSITORY', repository)
+        self.setdefault('SAVE_DIRECTORY',
+                        os.path.join(parent['SAVE_DIRECTORY'],
+                                     *repository.split('/')))
+        if parent.get('INDEX_DIRECTORY'):
+            self.setdefault('INDEX_DIRECTORY',
+                            os.path.join(parent['INDEX_DIRECTORY'],
+                                         *repository.split('/')))
+
+    def __missing__(self, key):
+        return self.parent[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.parent
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def make_configs(config):
+    """Makes :class:`RepositoryConfig` of each repository of
+    ``REPOSITORIES``, which is either a list of names or a dictionary of
+    names to their own configs.
+
+    :returns: the ordered dictionary of names to configs
+    :rtype: :class:`collections.OrderedDict`
+
+    """
+    repositories = config['REPOSITORIES']
+    if isinstance(repositories, collections.Mapping):
+        items = sorted(repositories.items())
+    else:
+        items = [(repository, None) for repository in repositories]
+    configs = collections.OrderedDict()
+    for repository, overrides in items:
+        configs[repository] = RepositoryConfig(config, repository, overrides)
+    return configs
+
+
+def get_root_config(config):
+    """The root config of the ``config``.  It's the ``config`` itself if
+    it's not of a hosted repository.
+
+    """
+    if isinstance(config, RepositoryConfig):
+        return config.parent
+    return config
+
+
+class RepositoryDispatcher(object):
+    """The WSGI middleware which dispatches requests to ``/<owner>/<repo>/``
+    to the ``app`` with the config of the repository.  The prefix is moved
+    from ``PATH_INFO`` to ``SCRIPT_NAME``, so URLs the app builds contain
+    it.  Only ``GET`` requests to :const:`ROOT_PATHS` are served at
+    the root.
+
+    :param app: the WSGI application
+    :param configs: the list of configs of repositories
+
+    """
+
+    def __init__(self, app, configs):
+        self.app = app
+        self.configs = dict((config['REPOSITORY'].lower(), config)
+                            for config in configs)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '') or '/'
+        segments = path.split('/', 3)
+        if len(segments) > 2:
+            config = self.configs.get('/'.join(segments[1:3]).lower())
+            if config is not None:
+                if len(segments) < 4:
+                    location = environ.get('SCRIPT_NAME', '') + path + '/'
+                    return redirect(location, 301)(environ, start_response)
+                script_name = environ.get('SCRIPT_NAME', '')
+                environ[CONFIG_ENVIRON_KEY] = config
+                environ[SCRIPT_ROOT_ENVIRON_KEY] = script_name
+                environ['SCRIPT_NAME'] = script_name + '/'.join(segments[:3])
+                environ['PATH_INFO'] = '/' + segments[3]
+                return self.app(environ, start_response)
+        if (path in ROOT_PATHS and
+                environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD')):
+            return self.app(environ, start_response)
+        return NotFound()(environ, start_response)
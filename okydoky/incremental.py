@@ -0,0 +1,310 @@
+""":mod:`okydoky.incremental` --- Incremental Sphinx builds
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Okydoky keeps the doctrees (which contain the pickled environment of Sphinx)
+and the HTML output of the last successful build, and seeds the working
+directory of the next build with them.  Sphinx then re-reads and re-writes
+only documents that have changed since.
+
+Caches are keyed by the repository, the Sphinx version and the content of
+``conf.py``, so that changing the configuration or the set of extensions
+makes a full rebuild.  Removing or renaming files makes a full rebuild
+as well, since Sphinx doesn't remove outputs of removed documents.
+
+Sphinx discards the pickled environment if the source directory has
+changed, so builds run in working directories of stable paths, which are
+leased one build at a time (see :func:`lease_work_dir()`), and caches are
+keyed by the path as well.
+
+Commits whose docs inputs are the same as an already published build,
+e.g., ones which change only tests or CI settings, aren't built at all.
+The published docs are reused instead (see :func:`get_fingerprint()`).
+
+"""
+import ConfigParser
+import errno
+import fnmatch
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from eventlet import tpool
+from eventlet.green import subprocess
+from flask import json
+
+from .cluster import FileLock
+
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores caches.
+CACHE_DIRNAME = '_doctrees'
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores working directories of builds.
+WORK_DIRNAME = '_work'
+
+#: (:class:`str`) The relative path of the directory which
+#: ``setup.py build_sphinx`` builds into.
+BUILD_DIR = os.path.join('build', 'sphinx')
+
+#: (:class:`int`) The number of caches to keep.  Older ones are removed.
+CACHE_SIZE = 4
+
+#: (:class:`float`) The modification time given to unchanged files.
+#: It has to be older than any time Sphinx could read a document at.
+UNCHANGED_MTIME = 1.0
+
+#: (:class:`tuple`) The default patterns of files which don't affect
+#: the docs.  It can be overridden by ``FINGERPRINT_EXCLUDE`` config.
+#: Patterns are relative to the root of the repository, and a directory
+#: pattern excludes all files in it.
+DEFAULT_FINGERPRINT_EXCLUDE = (
+    '.git*', '.github', '.travis.yml', '.circleci', 'appveyor.yml',
+    'tox.ini', '.coveragerc', 'test', 'tests', '*/test', '*/tests'
+)
+
+
+def find_conf(path):
+    """Finds the Sphinx ``conf.py`` of the project extracted to ``path``.
+    Returns ``None`` if there's no ``conf.py``.
+
+    """
+    parser = ConfigParser.RawConfigParser()
+    parser.read(os.path.join(path, 'setup.cfg'))
+    candidates = []
+    for option in 'source-dir', 'source_dir':
+        if parser.has_option('build_sphinx', option):
+            candidates.append(parser.get('build_sphinx', option))
+    candidates.extend(['doc', 'docs'])
+    for candidate in candidates:
+        conf = os.path.join(path, candidate, 'conf.py')
+        if os.path.isfile(conf):
+            return conf
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.startswith('.') and d != 'build')
+        if 'conf.py' in filenames:
+            return os.path.join(dirpath, 'conf.py')
+
+
+def file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while 1:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_tree(path):
+    """Makes the manifest of the source tree in ``path``, a dictionary of
+    relative paths to their SHA-1 digests.  The build directory is excluded.
+
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        if dirpath == path and 'build' in dirnames:
+            dirnames.remove('build')
+        for filename in filenames:
+            fullname = os.path.join(dirpath, filename)
+            if os.path.islink(fullname) or not os.path.isfile(fullname):
+                continue
+            manifest[os.path.relpath(fullname, path)] = file_digest(fullname)
+    return manifest
+
+
+def get_fingerprint(path, config):
+    """Gets the fingerprint of docs inputs of the project extracted to
+    ``path``, i.e., the digest of all files except ones which match
+    ``FINGERPRINT_EXCLUDE`` patterns.  Commits of the same fingerprint
+    make the same docs.
+
+    :param path: the working directory
+    :param config: the config dictionary
+
+    """
+    exclude = config.get('FINGERPRINT_EXCLUDE', DEFAULT_FINGERPRINT_EXCLUDE)
+    digest = hashlib.sha1()
+    for relpath, file_hash in sorted(hash_tree(path).iteritems()):
+        for pattern in exclude:
+            pattern = pattern.rstrip('/')
+            if (fnmatch.fnmatch(relpath, pattern) or
+                    fnmatch.fnmatch(relpath, pattern + '/*')):
+                break
+        else:
+            digest.update(relpath + '\0' + file_hash + '\0')
+    return digest.hexdigest()
+
+
+def lease_work_dir(path, config):
+    """Moves the project extracted to ``path`` to the first idle working
+    directory, ``_work/<n>`` under ``SAVE_DIRECTORY``, so that Sphinx sees
+    the same source directory as the build which made the cache.  What
+    the last build left there is removed.
+
+    :returns: a pair of the path of the working directory and
+              the :class:`~okydoky.cluster.FileLock` which has to be
+              released when the build finishes
+    :rtype: :class:`tuple`
+
+    """
+    root = os.path.join(config['SAVE_DIRECTORY'], WORK_DIRNAME)
+    if not os.path.isdir(root):
+        try:
+            os.makedirs(root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    n = 0
+    while 1:
+        work_dir = os.path.join(root, str(n))
+        lock = FileLock(work_dir + '.lock')
+        if lock.acquire(blocking=False):
+            break
+        n += 1
+    try:
+        if os.path.exists(work_dir):
+            tpool.execute(shutil.rmtree, work_dir)
+        os.rename(path, work_dir)
+    except Exception:
+        lock.release()
+        raise
+    return work_dir, lock
+
+
+def get_cache_key(path, python, config):
+    """Gets the cache key of the project extracted to ``path``.
+
+    :param path: the working directory
+    :param python: the path of the Python interpreter of the virtualenv
+                   which has Sphinx installed
+    :param config: the config dictionary
+
+    """
+    cmd = [python, '-c', 'import sphinx; print(sphinx.__version__)']
+    # Unlike check_output(), Popen is green in every version of eventlet.
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    sphinx_version = process.communicate()[0].strip()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    digest = hashlib.sha1(config['REPOSITORY'])
+    digest.update('\0' + sphinx_version + '\0')
+    # The pickled environment is valid only in the same source directory.
+    digest.update(os.path.abspath(path) + '\0')
+    conf = find_conf(path)
+    if conf is not None:
+        digest.update(os.path.relpath(conf, path) + '\0')
+        digest.update(file_digest(conf))
+    return digest.hexdigest()
+
+
+def get_cache_dir(key, config):
+    return os.path.join(config['SAVE_DIRECTORY'], CACHE_DIRNAME, key)
+
+
+def restore_cache(path, key, config):
+    """Seeds the build directory of ``path`` with the cache of ``key``,
+    and touches files so that Sphinx notices only changed files.  If any
+    file has been removed since the cache, nothing is restored, so that
+    the output doesn't contain stale pages.  Returns the manifest of
+    the source tree, which has to be passed to :func:`store_cache()` after
+    the build.
+
+    """
+    logger = logging.getLogger(__name__ + '.restore_cache')
+    manifest = hash_tree(path)
+    cache_dir = get_cache_dir(key, config)
+    build_dir = os.path.join(path, BUILD_DIR)
+    try:
+        with open(os.path.join(cache_dir, 'sources.json')) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        logger.info('no cache for %s; full build', key)
+        return manifest
+    if os.path.exists(build_dir):
+        logger.info('%s already exists; full build', build_dir)
+        return manifest
+    # Sphinx never removes outputs of removed or renamed documents, so
+    # they would be left in the output.
+    removed = [relpath for relpath in cached if relpath not in manifest]
+    if removed:
+        logger.info('%d files have been removed since the cache %s; '
+                    'full build', len(removed), key)
+        return manifest
+    try:
+        for name in 'doctrees', 'html':
+            shutil.copytree(os.path.join(cache_dir, name),
+                            os.path.join(build_dir, name))
+    except (IOError, OSError, shutil.Error):
+        logger.exception('failed to restore the cache %s; full build',
+                         cache_dir)
+        shutil.rmtree(build_dir, ignore_errors=True)
+        return manifest
+    now = time.time()
+    changes = 0
+    for relpath, digest in manifest.iteritems():
+        if cached.get(relpath) == digest:
+            mtime = UNCHANGED_MTIME
+        else:
+            mtime = now
+            changes += 1
+        os.utime(os.path.join(path, relpath), (mtime, mtime))
+    logger.info('restored the cache %s into %s; %d of %d files changed',
+                key, build_dir, changes, len(manifest))
+    return manifest
+
+
+def store_cache(path, key, manifest, config):
+    """Stores the doctrees and the HTML output of the successful build in
+    ``path`` as the cache of ``key``.  The doctrees are moved, and the HTML
+    output is copied.
+
+    """
+    logger = logging.getLogger(__name__ + '.store_cache')
+    cache_root = os.path.join(config['SAVE_DIRECTORY'], CACHE_DIRNAME)
+    if not os.path.isdir(cache_root):
+        os.makedirs(cache_root)
+    build_dir = os.path.join(path, BUILD_DIR)
+    tmp = tempfile.mkdtemp(prefix='.' + key + '.', dir=cache_root)
+    try:
+        shutil.move(os.path.join(build_dir, 'doctrees'),
+                    os.path.join(tmp, 'doctrees'))
+        shutil.copytree(os.path.join(build_dir, 'html'),
+                        os.path.join(tmp, 'html'))
+        with open(os.path.join(tmp, 'sources.json'), 'w') as f:
+            json.dump(manifest, f)
+        cache_dir = get_cache_dir(key, config)
+        if os.path.isdir(cache_dir):
+            old = tempfile.mkdtemp(prefix='.' + key + '.', dir=cache_root)
+            os.rename(cache_dir, os.path.join(old, key))
+        else:
+            old = None
+        os.rename(tmp, cache_dir)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+    logger.info('stored the cache %s', cache_dir)
+    prune_caches(config)
+
+
+def prune_caches(config):
+    """Removes all caches except :const:`CACHE_SIZE` most recent ones."""
+    logger = logging.getLogger(__name__ + '.prune_caches')
+    cache_root = os.path.join(config['SAVE_DIRECTORY'], CACHE_DIRNAME)
+    caches = []
+    for name in os.listdir(cache_root):
+        if not name.startswith('.'):
+            fullname = os.path.join(cache_root, name)
+            caches.append((os.stat(fullname).st_mtime, fullname))
+    caches.sort(reverse=True)
+    for _, fullname in caches[CACHE_SIZE:]:
+        shutil.rmtree(fullname, ignore_errors=True)
+        logger.info('removed the old cache %s', fullname)
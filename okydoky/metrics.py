@@ -0,0 +1,297 @@
+""":mod:`okydoky.metrics` --- Metrics of builds and requests
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Each process collects its own metrics e.g. timings of build phases,
+latencies of requests and the number of requests to GitHub.  Build
+workers write snapshots of their metrics into ``metrics.<worker>.json``
+under ``SAVE_DIRECTORY`` every :const:`SNAPSHOT_INTERVAL` seconds, and
+the web server exposes its own metrics and the snapshots on ``/metrics`` in
+the Prometheus_ text format, labeled by ``process`` and ``worker``.
+
+Timings of phases of each build are stored in the build index as well.
+
+.. _Prometheus: http://prometheus.io/
+
+"""
+import contextlib
+import glob
+import os
+import os.path
+import tempfile
+import time
+
+from flask import json
+
+
+#: (:class:`str`) The filename pattern of snapshots of build workers'
+#: metrics under ``SAVE_DIRECTORY``.  ``{0}`` is the name of the worker.
+SNAPSHOT_FILENAME = 'metrics.{0}.json'
+
+#: (:class:`int`) The seconds between snapshots.  Snapshots older than
+#: four times of it are considered the worker is dead.
+SNAPSHOT_INTERVAL = 15
+
+#: (:class:`tuple`) The default upper bounds of histogram buckets in
+#: seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600, 1800)
+
+
+class Registry(object):
+    """The set of metrics of the process."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        """Collects the metric families, which can be rendered by
+        :func:`render()` or serialized into JSON.
+
+        """
+        return [metric.collect() for metric in self.metrics]
+
+
+#: (:class:`Registry`) The default registry.
+registry = Registry()
+
+
+class Metric(object):
+    """The base class of metrics.  Values are kept for each set of labels.
+
+    :param name: the name of the metric
+    :param help: the description of the metric
+    :param registry: the :class:`Registry` to register to
+
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, registry=registry):
+        self.name = name
+        self.help = help
+        self.values = {}
+        registry.register(self)
+
+    def collect(self):
+        samples = []
+        for key, value in sorted(self.values.iteritems()):
+            samples.extend(self.get_samples(dict(key), value))
+        return {'name': self.name, 'type': self.type, 'help': self.help,
+                'samples': samples}
+
+    def get_samples(self, labels, value):
+        return [[self.name, labels, value]]
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.iteritems()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.iteritems()))] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS,
+                 registry=registry):
+        super(Histogram, self).__init__(name, help, registry)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.iteritems()))
+        try:
+            counts, total = self.values[key]
+        except KeyError:
+            counts, total = [0] * (len(self.buckets) + 1), 0
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.values[key] = counts, total + value
+
+    def get_samples(self, labels, value):
+        counts, total = value
+        samples = []
+        cumulative = 0
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            bucket_labels = dict(labels, le=bound)
+            samples.append([self.name + '_bucket', bucket_labels, cumulative])
+        samples.append([self.name + '_sum', labels, total])
+        samples.append([self.name + '_count', labels, cumulative])
+        return samples
+
+
+class CountingReader(object):
+    """Wraps the file-like object ``fp`` to count bytes read from it into
+    the ``counter``.
+
+    """
+
+    def __init__(self, fp, counter):
+        self.fp = fp
+        self.counter = counter
+
+    def read(self, amt=None):
+        data = self.fp.read() if amt is None else self.fp.read(amt)
+        self.counter.inc(len(data))
+        return data
+
+
+#: (:class:`Histogram`) Seconds spent in each phase of builds.
+BUILD_PHASE_SECONDS = Histogram('okydoky_build_phase_seconds',
+                                'Seconds spent in each phase of builds.')
+
+#: (:class:`Histogram`) Seconds from enqueueing commits to publishing
+#: their docs.
+BUILD_LATENCY_SECONDS = Histogram(
+    'okydoky_build_latency_seconds',
+    'Seconds from enqueueing commits to publishing their docs.'
+)
+
+#: (:class:`Counter`) Finished builds by their status.
+BUILDS_TOTAL = Counter('okydoky_builds_total',
+                       'Finished builds by their status.')
+
+#: (:class:`Gauge`) Builds in the pipeline.
+BUILDS_RUNNING = Gauge('okydoky_builds_running', 'Builds in the pipeline.')
+
+#: (:class:`Gauge`) Pending jobs in the build queue.
+QUEUE_DEPTH = Gauge('okydoky_queue_depth',
+                    'Pending jobs in the build queue.')
+
+#: (:class:`Counter`) Bytes of downloaded archives.
+ARCHIVE_BYTES = Counter('okydoky_archive_bytes_total',
+                        'Bytes of downloaded archives.')
+
+#: (:class:`Counter`) Bytes of published docs saved by deduplication.
+DEDUP_SAVED_BYTES = Counter('okydoky_dedup_saved_bytes_total',
+                            'Bytes of published docs saved by '
+                            'deduplication.')
+
+#: (:class:`Histogram`) Seconds spent to respond to requests by endpoint.
+REQUEST_SECONDS = Histogram('okydoky_request_seconds',
+                            'Seconds spent to respond to requests.')
+
+#: (:class:`Counter`) Requests to GitHub by method and status.
+GITHUB_REQUESTS = Counter('okydoky_github_requests_total',
+                          'Requests to GitHub by method and status.')
+
+
+@contextlib.contextmanager
+def timed(timings, phase):
+    """Measures the ``phase`` of the build, and adds the seconds to
+    the ``timings`` dictionary of the build (if it's not ``None``) and
+    :const:`BUILD_PHASE_SECONDS`.
+
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0) + elapsed
+        BUILD_PHASE_SECONDS.observe(elapsed, phase=phase)
+
+
+def add_labels(families, **labels):
+    """Adds ``labels`` to all samples of metric ``families``."""
+    return [dict(family, samples=[[name, dict(sample_labels, **labels), value]
+                                  for name, sample_labels, value
+                                  in family['samples']])
+            for family in families]
+
+
+def escape(value):
+    return (unicode(value).replace('\\', r'\\').replace('\n', r'\n')
+                          .replace('"', r'\"'))
+
+
+def render(families):
+    """Renders metric ``families`` in the Prometheus text format.  Families
+    of the same name e.g. from different processes are merged.
+
+    """
+    merged = {}
+    order = []
+    for family in families:
+        if family['name'] not in merged:
+            merged[family['name']] = dict(family, samples=[])
+            order.append(family['name'])
+        merged[family['name']]['samples'].extend(family['samples'])
+    lines = []
+    for name in order:
+        family = merged[name]
+        lines.append(u'# HELP {0} {1}'.format(name, escape(family['help'])))
+        lines.append(u'# TYPE {0} {1}'.format(name, family['type']))
+        for sample_name, labels, value in family['samples']:
+            if labels:
+                sample_name += u'{' + u','.join(
+                    u'{0}="{1}"'.format(key, escape(labels[key]))
+                    for key in sorted(labels)
+                ) + u'}'
+            lines.append(u'{0} {1!r}'.format(sample_name, float(value)))
+    return u'\n'.join(lines) + u'\n'
+
+
+def write_snapshot(config, worker, registry=registry):
+    """Writes the snapshot of the ``registry`` into :const:`SNAPSHOT_FILENAME`
+    under ``SAVE_DIRECTORY``.
+
+    :param config: the config dictionary
+    :param worker: the name of the build worker, unique among nodes
+                   sharing the ``SAVE_DIRECTORY``
+    :param registry: the :class:`Registry` to write
+
+    """
+    save_dir = config['SAVE_DIRECTORY']
+    fd, tmp = tempfile.mkstemp(prefix='.', dir=save_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(registry.collect(), f)
+    os.rename(tmp, os.path.join(save_dir, SNAPSHOT_FILENAME.format(worker)))
+
+
+def read_snapshot(config):
+    """Reads fresh snapshots written by :func:`write_snapshot()`.  Samples
+    are labeled by ``worker``.  Stale snapshots, e.g. of workers which
+    have gone, are removed.
+
+    """
+    save_dir = config['SAVE_DIRECTORY']
+    prefix, suffix = SNAPSHOT_FILENAME.split('{0}')
+    families = []
+    for filename in glob.glob(os.path.join(save_dir, prefix + '*' + suffix)):
+        worker = os.path.basename(filename)[len(prefix):-len(suffix)]
+        try:
+            if (os.stat(filename).st_mtime <
+                    time.time() - SNAPSHOT_INTERVAL * 4):
+                os.unlink(filename)
+                continue
+            with open(filename) as f:
+                families.extend(add_labels(json.load(f), worker=worker))
+        except (IOError, OSError, ValueError):
+            continue
+    return families
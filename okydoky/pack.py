@@ -0,0 +1,169 @@
+""":mod:`okydoky.pack` --- Single-file packs of built docs
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+If ``STORAGE_FORMAT`` is ``'pack'``, the built docs of each commit are
+packed into a single ``<sha>.pack`` file instead of a directory of
+thousands of small files.  A pack consists of:
+
+1. :const:`MAGIC`,
+2. the contents of files (and their precompressed siblings) one after
+   another,
+3. the JSON index which maps relative paths to entries,
+4. the offset of the index as a big-endian 64-bit integer, and
+5. :const:`MAGIC` again.
+
+Each entry of the index is a dictionary of ``offset``, ``size``, ``digest``
+(SHA-1 of the content) and ``type`` (the content type), and optionally
+``encodings``, which maps content encodings e.g. ``'gzip'`` to triples of
+the offset, the size and the digest of the precompressed payload.
+
+Packs are served from memory-mapped views, so that sending a file costs
+only a lookup of the index and a slice of the buffer.
+
+"""
+import hashlib
+import mimetypes
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+
+from flask import json
+
+from .compress import ENCODINGS
+
+
+#: (:class:`str`) The magic bytes at the start and the end of packs.
+MAGIC = 'OKYDOKY-PACK-1\n'
+
+#: (:class:`str`) The suffix of pack filenames.
+PACK_SUFFIX = '.pack'
+
+TRAILER = struct.Struct('>Q')
+
+
+def append_file(pack, filename):
+    """Appends the content of ``filename`` to the ``pack`` file object.
+
+    :returns: a list of the offset, the size and the digest of the content
+    :rtype: :class:`list`
+
+    """
+    offset = pack.tell()
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while 1:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            digest.update(chunk)
+            pack.write(chunk)
+    return [offset, pack.tell() - offset, digest.hexdigest()]
+
+
+def pack_build(build, filename):
+    """Packs the built docs ``build`` into the single file ``filename``.
+    The pack is written to a temporary file first, and then renamed, so
+    that it never appears half-written.
+
+    :returns: the size of the pack
+    :rtype: :class:`int`
+
+    """
+    paths = set()
+    for dirpath, _, filenames in os.walk(build):
+        for name in filenames:
+            fullname = os.path.join(dirpath, name)
+            if os.path.isfile(fullname):
+                relpath = os.path.relpath(fullname, build)
+                paths.add(relpath.replace(os.sep, '/'))
+    siblings = set()
+    for path in paths:
+        for _, suffix in ENCODINGS:
+            if path.endswith(suffix) and path[:-len(suffix)] in paths:
+                siblings.add(path)
+    index = {}
+    fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            for path in sorted(paths - siblings):
+                fullname = os.path.join(build, *path.split('/'))
+                offset, size, digest = append_file(f, fullname)
+                entry = {
+                    'offset': offset,
+                    'size': size,
+                    'digest': digest,
+                    'type': (mimetypes.guess_type(path)[0] or
+                             'application/octet-stream')
+                }
+                for encoding, suffix in ENCODINGS:
+                    if path + suffix in siblings:
+                        encodings = entry.setdefault('encodings', {})
+                        encodings[encoding] = append_file(f, fullname + suffix)
+                index[path] = entry
+            index_offset = f.tell()
+            json.dump(index, f)
+            f.write(TRAILER.pack(index_offset))
+            f.write(MAGIC)
+            size = f.tell()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, filename)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    return size
+
+
+class Pack(object):
+    """The memory-mapped view of the pack ``filename``.
+
+    :raises ValueError: if the file isn't a pack
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        #: The device and inode numbers of the mapped file.
+        self.version = stat.st_dev, stat.st_ino
+        try:
+            trailer_start = len(self.mmap) - len(MAGIC) - TRAILER.size
+            if (trailer_start < len(MAGIC) or
+                    self.mmap[:len(MAGIC)] != MAGIC or
+                    self.mmap[-len(MAGIC):] != MAGIC):
+                raise ValueError(filename + ' is not a pack')
+            index_offset, = TRAILER.unpack(
+                self.mmap[trailer_start:trailer_start + TRAILER.size]
+            )
+            self.index = json.loads(self.mmap[index_offset:trailer_start])
+        except Exception:
+            self.mmap.close()
+            raise
+
+    def find(self, path):
+        """Finds the entry of ``path``.  Returns ``None`` if there's no
+        such file.
+
+        """
+        return self.index.get(path)
+
+    def is_removed(self):
+        """Tests whether the file has been removed, or replaced by another
+        file, since it was mapped.
+
+        """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return True
+        return (stat.st_dev, stat.st_ino) != self.version
+
+    def read(self, offset, size):
+        return self.mmap[offset:offset + size]
+
+    def close(self):
+        self.mmap.close()
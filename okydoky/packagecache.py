@@ -0,0 +1,86 @@
+""":mod:`okydoky.packagecache` --- Local package cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Distributions which builds download from the package index are kept in
+the ``_packages`` directory under ``SAVE_DIRECTORY``, and dependencies are
+installed from there first (``--find-links``).  The package index is
+searched only for requirements the cache doesn't satisfy, or never if
+``PACKAGE_CACHE_ONLY`` is turned on.
+
+The cache can be filled in advance by :mod:`okydoky.prefetch`.
+
+"""
+import contextlib
+import errno
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+
+from .hosting import get_root_config
+
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores cached distributions.
+PACKAGES_DIRNAME = '_packages'
+
+#: (:class:`tuple`) Suffixes of distribution files to cache.
+DISTRIBUTION_SUFFIXES = ('.tar.gz', '.tgz', '.tar.bz2', '.zip', '.egg',
+                         '.whl')
+
+
+class PackageCache(object):
+    """The local cache of distributions.  It's shared by all hosted
+    repositories.
+
+    :param config: the config dictionary
+
+    """
+
+    def __init__(self, config):
+        save_dir = get_root_config(config)['SAVE_DIRECTORY']
+        self.path = os.path.join(save_dir, PACKAGES_DIRNAME)
+        self.offline = config.get('PACKAGE_CACHE_ONLY', False)
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @contextlib.contextmanager
+    def options(self, offline=None):
+        """Yields options of ``easy_install`` and ``setup.py develop``
+        which install distributions from the cache first.  Distributions
+        downloaded meanwhile are added to the cache if the installation
+        succeeds.
+
+        :param offline: whether not to access the package index at all.
+                        ``PACKAGE_CACHE_ONLY`` config by default
+
+        """
+        if offline is None:
+            offline = self.offline
+        # Subdirectories of find-links aren't looked into, so it's safe to
+        # download into the cache directory.
+        build_dir = tempfile.mkdtemp(prefix='.', dir=self.path)
+        options = ['--find-links', self.path, '--build-directory', build_dir]
+        if offline:
+            options.extend(['--allow-hosts', 'None'])
+        try:
+            yield options
+            self.collect(build_dir)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def collect(self, build_dir):
+        """Moves distributions downloaded into ``build_dir`` to the cache."""
+        logger = logging.getLogger(__name__ + '.PackageCache.collect')
+        for name in os.listdir(build_dir):
+            filename = os.path.join(build_dir, name)
+            target = os.path.join(self.path, name)
+            if (name.endswith(DISTRIBUTION_SUFFIXES) and
+                    os.path.isfile(filename) and not os.path.exists(target)):
+                os.rename(filename, target)
+                logger.info('cached %s', name)
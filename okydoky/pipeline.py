@@ -0,0 +1,67 @@
+""":mod:`okydoky.pipeline` --- Staged build pipeline
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Builds go through stages e.g. fetch, install, Sphinx and publish.  Each
+stage has its own number of workers, and stages are connected by bounded
+queues, so that archives of a multi-commit push are downloaded while other
+commits are being built, and Sphinx runs for several commits in parallel.
+
+"""
+import logging
+import sys
+
+from eventlet import spawn_n
+from eventlet.queue import LightQueue
+
+
+class Pipeline(object):
+    """The pipeline of ``stages``.  Items put into the pipeline are passed
+    to the function of each stage in order.  If a function returns
+    ``False`` or raises an exception, the item skips the rest of stages.
+
+    :param stages: the list of triples of the stage name, the function which
+                   takes an item, and the number of workers of the stage
+    :param finish: the function called with each item and the triple
+                   :func:`sys.exc_info()` returns if a stage failed
+                   (``None`` if it didn't) after the item left the pipeline
+    :param buffer_size: the number of items which can wait for each stage
+
+    """
+
+    def __init__(self, stages, finish, buffer_size=1):
+        self.stages = stages
+        self.finish = finish
+        self.queues = [LightQueue(buffer_size) for _ in stages]
+        for i, (_, _, concurrency) in enumerate(stages):
+            for _ in xrange(concurrency):
+                spawn_n(self._work, i)
+
+    def put(self, item):
+        """Puts the ``item`` into the pipeline.  It blocks while the first
+        stage is full.
+
+        """
+        self.queues[0].put(item)
+
+    def _work(self, i):
+        logger = logging.getLogger(__name__ + '.Pipeline._work')
+        name, function, _ = self.stages[i]
+        queue = self.queues[i]
+        while 1:
+            item = queue.get()
+            logger.debug('stage %s: %r', name, item)
+            try:
+                proceed = function(item)
+            except Exception:
+                exc_info = sys.exc_info()
+                logger.info('stage %s failed', name, exc_info=exc_info)
+                proceed = False
+            else:
+                exc_info = None
+            if proceed is not False and i + 1 < len(self.queues):
+                self.queues[i + 1].put(item)
+                continue
+            try:
+                self.finish(item, exc_info)
+            except Exception:
+                logger.exception('failed to finish %r', item)
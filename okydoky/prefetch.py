@@ -0,0 +1,84 @@
+""":mod:`okydoky.prefetch` --- Prefetch of the package cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Downloads the latest versions of Sphinx and dependencies of the head of
+each repository into the package cache
+(:mod:`okydoky.packagecache`), so that builds don't have to access
+the package index, even if ``PACKAGE_CACHE_ONLY`` is turned on:
+
+.. code-block:: console
+
+   $ python -m okydoky.prefetch yourconfig.py
+   $ python -m okydoky.prefetch -r 'docutils<0.13' yourconfig.py
+
+"""
+from __future__ import absolute_import
+
+import logging
+import optparse
+import os.path
+import shutil
+import sys
+import tempfile
+
+from .app import (app, fetch_archive, get_bindir, get_build_environ,
+                  get_head, get_repository_configs, get_token, run_command)
+from .envpool import SPHINX_REQUIREMENT, create_virtualenv
+from .packagecache import PackageCache
+from .run import configure
+
+
+parser = optparse.OptionParser(usage='%prog [options] config')
+parser.add_option('-r', '--requirement', action='append', default=[],
+                  dest='requirements',
+                  help='an additional requirement to download; '
+                       'can be specified multiple times')
+parser.add_option('-d', '--debug', action='store_true',
+                  help='debug mode')
+parser.add_option('-q', '--quiet', action='store_const', const=logging.ERROR,
+                  dest='verbosity', help='suppress output')
+parser.add_option('-v', '--verbose', action='store_const', const=logging.INFO,
+                  dest='verbosity', help='enable additional output')
+
+
+def prefetch(cache, requirements, config, log=sys.stdout):
+    """Downloads ``requirements``, Sphinx and dependencies of the head
+    of each repository into the ``cache``.  The package index is always
+    searched for the latest versions.
+
+    """
+    logger = logging.getLogger(__name__ + '.prefetch')
+    envdir = tempfile.mkdtemp(prefix='okydoky-prefetch-')
+    try:
+        create_virtualenv(envdir)
+        bindir = get_bindir(envdir)
+        with cache.options(offline=False) as options:
+            run_command([os.path.join(bindir, 'easy_install'), '--upgrade'] +
+                        options + [SPHINX_REQUIREMENT] + list(requirements),
+                        log)
+        for repo_config in get_repository_configs(config):
+            head = get_head(repo_config)
+            if head is None:
+                logger.info('%s has no head; skip...',
+                            repo_config['REPOSITORY'])
+                continue
+            path = fetch_archive(head, get_token(repo_config), repo_config)
+            try:
+                with cache.options(offline=False) as options:
+                    run_command([os.path.join(bindir, 'python'), 'setup.py',
+                                 'develop', '--upgrade'] + options, log,
+                                cwd=path, env=get_build_environ())
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+    finally:
+        shutil.rmtree(envdir, ignore_errors=True)
+
+
+def main(*args, **kwargs):
+    options, args = parser.parse_args(*args, **kwargs)
+    configure(parser, options, args)
+    prefetch(PackageCache(app.config), options.requirements, app.config)
+
+
+if __name__ == '__main__':
+    main()
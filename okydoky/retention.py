@@ -0,0 +1,158 @@
+""":mod:`okydoky.retention` --- Retention of old builds
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+If ``RETAIN_BUILDS`` is set, old builds are evicted by the sweeper which
+runs in the build worker every ``RETENTION_INTERVAL`` seconds, and right
+after a build is published if the disk usage of ``SAVE_DIRECTORY`` is
+above ``DISK_HIGH_WATERMARK``.  The following builds are retained:
+
+- the head,
+- ``RETAIN_BUILDS`` most recent successful builds,
+- tagged commits (unless ``RETAIN_TAGS`` is turned off), and
+- builds built or accessed within ``RETAIN_ACCESSED_DAYS`` days.
+
+If the disk usage is still above the watermark, builds retained only
+because of recent accesses are evicted as well, the oldest first.
+
+Evicted builds are removed, or moved to the ``_cold`` directory as
+compressed tarballs if ``COLD_STORAGE`` is turned on.
+
+"""
+import logging
+import os
+import os.path
+import re
+import tarfile
+import tempfile
+import time
+
+from .buildlog import remove_log
+from .github import client, get_api_url
+from .pack import PACK_SUFFIX
+from .search import SearchIndex
+from .store import collect_garbage, unpublish
+
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores evicted builds.
+COLD_DIRNAME = '_cold'
+
+
+def get_disk_usage(path):
+    """The fraction of the used space of the filesystem of ``path``."""
+    stat = os.statvfs(path)
+    return 1 - float(stat.f_bavail) / stat.f_blocks
+
+
+def get_excess_size(path, watermark):
+    """The number of bytes to free to make the disk usage of ``path``
+    the ``watermark``.
+
+    """
+    stat = os.statvfs(path)
+    used = stat.f_blocks - stat.f_bavail
+    return int((used - stat.f_blocks * watermark) * stat.f_frsize)
+
+
+def get_tagged_commits(token, config):
+    """Gets the set of commits which are tagged in the repository."""
+    url = get_api_url(
+        '/repos/{0}/tags?per_page=100'.format(config['REPOSITORY']), config
+    )
+    commits = set()
+    while url:
+        response = client.request('GET', url, token=token)
+        commits.update(tag['commit']['sha'] for tag in response.json())
+        match = re.search(r'<([^>]+)>;\s*rel="next"',
+                          response.headers.get('link', ''))
+        url = match and match.group(1)
+    return commits
+
+
+def archive_build(result_dir, config):
+    """Moves the published docs of ``result_dir`` into the cold storage
+    as a compressed tarball.
+
+    :returns: the number of bytes freed
+    :rtype: :class:`int`
+
+    """
+    cold_dir = os.path.join(config['SAVE_DIRECTORY'], COLD_DIRNAME)
+    if not os.path.isdir(cold_dir):
+        os.makedirs(cold_dir)
+    sha = os.path.basename(result_dir)
+    fd, tmp = tempfile.mkstemp(prefix='.', dir=cold_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            tar = tarfile.open(fileobj=f, mode='w:gz')
+            if os.path.isdir(result_dir):
+                tar.add(result_dir, sha)
+            else:
+                tar.add(result_dir + PACK_SUFFIX, sha + PACK_SUFFIX)
+            tar.close()
+        filename = os.path.join(cold_dir, sha + '.tar.gz')
+        os.rename(tmp, filename)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    return unpublish(result_dir, config) - os.path.getsize(filename)
+
+
+def evict(index, build, config):
+    """Evicts the ``build``.  Returns the number of bytes freed."""
+    logger = logging.getLogger(__name__ + '.evict')
+    sha = build['sha']
+    result_dir = os.path.join(config['SAVE_DIRECTORY'], sha)
+    if config.get('SEARCH_INDEX', True):
+        SearchIndex(config).remove(sha)
+    remove_log(sha, config)
+    if build['status'] == 'success' and config.get('COLD_STORAGE', False):
+        index.set_status(sha, 'archived')
+        freed = archive_build(result_dir, config)
+        logger.info('moved %s to the cold storage', sha)
+    else:
+        index.remove(sha)
+        freed = unpublish(result_dir, config)
+        logger.info('evicted %s', sha)
+    return freed
+
+
+def sweep(index, protected, config):
+    """Evicts builds which aren't retained.
+
+    :param index: the :class:`~okydoky.buildindex.BuildIndex`
+    :param protected: the set of commits which have to be retained
+                      e.g. the head and tagged commits
+    :param config: the config dictionary
+    :returns: the number of evicted builds
+    :rtype: :class:`int`
+
+    """
+    logger = logging.getLogger(__name__ + '.sweep')
+    save_dir = config['SAVE_DIRECTORY']
+    keep = config['RETAIN_BUILDS']
+    days = config.get('RETAIN_ACCESSED_DAYS', 30)
+    watermark = config.get('DISK_HIGH_WATERMARK', 0.9)
+    count = 0
+    for build in index.list_expired(keep, time.time() - days * 86400):
+        if build['sha'] not in protected:
+            evict(index, build, config)
+            count += 1
+    if get_disk_usage(save_dir) > watermark:
+        logger.warning('disk usage of %s is above %.0f%%; evict recently '
+                       'accessed builds as well', save_dir, watermark * 100)
+        # Objects within the grace period aren't removed until they're
+        # collected later, so the freed space is counted instead of
+        # measuring the disk usage again.
+        excess = get_excess_size(save_dir, watermark)
+        for build in index.list_expired(keep, time.time()):
+            if excess <= 0:
+                break
+            elif build['sha'] not in protected:
+                excess -= evict(index, build, config)
+                count += 1
+    collect_garbage(config)
+    if config.get('SEARCH_INDEX', True):
+        SearchIndex(config).collect_garbage()
+    logger.info('evicted %d builds in %s', count, save_dir)
+    return count
@@ -4,15 +4,20 @@
 """
 from __future__ import absolute_import
 
+import atexit
 import logging
 import optparse
 import os.path
+import sys
 
-from eventlet import listen
+from eventlet import listen, sleep, spawn_n
+from eventlet.green import subprocess
 from eventlet.wsgi import server
 from werkzeug.contrib.fixers import ProxyFix
 
-from .app import REQUIRED_CONFIGS, app
+from .app import (BUILD_POLICIES, REQUIRED_CONFIGS, app,
+                  get_repository_configs)
+from .hosting import RepositoryDispatcher
 
 
 parser = optparse.OptionParser()
@@ -25,6 +30,10 @@ parser.add_option('--proxy-fix', action='store_true', default=False,
                        'reverse proxies e.g. nginx, lighttpd')
 parser.add_option('--force-https', action='store_true', default=False,
                   help='redirect all HTTP requests to HTTPS locations')
+parser.add_option('--no-worker', action='store_false', dest='worker',
+                  default=True,
+                  help="don't run the build worker; run okydoky-worker "
+                       'separately instead')
 parser.add_option('-d', '--debug', action='store_true',
                   help='debug mode')
 parser.add_option('-q', '--quiet', action='store_const', const=logging.ERROR,
@@ -35,8 +44,11 @@ parser.add_option('--noisy', action='store_const', const=logging.DEBUG,
                   dest='verbosity', help='be noisy')
 
 
-def main(*args, **kwargs):
-    options, args = parser.parse_args(*args, **kwargs)
+def configure(parser, options, args):
+    """Sets up logging and loads the config file of ``args`` into
+    :data:`~okydoky.app.app`.  Returns the absolute path of the config file.
+
+    """
     if not args:
         parser.error('missing config file')
     elif len(args) > 1:
@@ -50,15 +62,66 @@ def main(*args, **kwargs):
     app.debug = debug
     app.config.from_pyfile(config_file)
     for conf in REQUIRED_CONFIGS:
-        if conf not in app.config:
+        # REPOSITORY isn't required if REPOSITORIES is set instead.
+        if conf == 'REPOSITORY' and app.config.get('REPOSITORIES'):
+            continue
+        elif conf not in app.config:
             parser.error('missing config: ' + conf)
+    for config in get_repository_configs(app.config):
+        if config.get('BUILD_POLICY', 'all') not in BUILD_POLICIES:
+            parser.error('BUILD_POLICY must be one of ' +
+                         ', '.join(map(repr, BUILD_POLICIES)))
+    return config_file
+
+
+def main(*args, **kwargs):
+    options, args = parser.parse_args(*args, **kwargs)
+    config_file = configure(parser, options, args)
+    if app.config.get('REPOSITORIES'):
+        app.wsgi_app = RepositoryDispatcher(
+            app.wsgi_app, get_repository_configs(app.config)
+        )
     if options.force_https:
         app.wsgi_app = ForcingHTTPSMiddleware(app.wsgi_app)
     if options.proxy_fix:
         app.wsgi_app = ProxyFix(app.wsgi_app)
+    if options.worker:
+        spawn_n(run_worker, config_file, options)
     server(listen((options.host, options.port)), app)
 
 
+def run_worker(config_file, options):
+    """Runs the build worker (:mod:`okydoky.worker`) in a separate process,
+    and restarts it whenever it exits.
+
+    """
+    logger = logging.getLogger(__name__ + '.run_worker')
+    args = [sys.executable, '-m', 'okydoky.worker', config_file]
+    if options.debug:
+        args.append('--debug')
+    verbosity_options = {
+        logging.ERROR: '--quiet',
+        logging.INFO: '--verbose',
+        logging.DEBUG: '--noisy'
+    }
+    if options.verbosity in verbosity_options:
+        args.append(verbosity_options[options.verbosity])
+    process = None
+    atexit.register(lambda: process is not None and terminate(process))
+    while 1:
+        process = subprocess.Popen(args)
+        logger.info('started the build worker (pid %d)', process.pid)
+        returncode = process.wait()
+        logger.error('the build worker exited with %d; restart...',
+                     returncode)
+        sleep(1)
+
+
+def terminate(process):
+    if process.poll() is None:
+        process.terminate()
+
+
 class ForcingHTTPSMiddleware(object):
     """It redirects all non-HTTPS requests to HTTPS locations."""
 
@@ -0,0 +1,167 @@
+""":mod:`okydoky.sandbox` --- Limits of build subprocesses
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Each build subprocess runs in its own process group, so that it can be
+killed with all of its children.  It's killed when it exceeds the timeout
+of its phase (see ``BUILD_TIMEOUTS`` config) or the build is cancelled.
+``BUILD_CPU_LIMIT`` and ``BUILD_MEMORY_LIMIT`` configs set resource limits
+of build subprocesses as well.
+
+"""
+import contextlib
+import errno
+import functools
+import os
+import signal
+import time
+
+from eventlet import sleep, spawn
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+#: (:class:`collections.Mapping`) The default wall-clock timeout of each
+#: phase in seconds.  It can be overridden by ``BUILD_TIMEOUTS`` config.
+#: ``None`` means no timeout.
+DEFAULT_TIMEOUTS = {
+    'develop': 30 * 60,
+    'easy_install': 10 * 60,
+    'build_sphinx': 30 * 60
+}
+
+#: (:class:`tuple`) The pairs of config keys and names of resource limits
+#: they set.
+RLIMIT_CONFIGS = (
+    ('BUILD_CPU_LIMIT', 'RLIMIT_CPU'),
+    ('BUILD_MEMORY_LIMIT', 'RLIMIT_AS')
+)
+
+#: (:class:`int`) The seconds between checks of timeouts and cancellation.
+WATCH_INTERVAL = 1
+
+#: (:class:`int`) The seconds to wait after ``SIGTERM`` before ``SIGKILL``.
+KILL_GRACE_PERIOD = 5
+
+
+class BuildAborted(Exception):
+    """Raised when a build is aborted.  Aborted builds aren't retried
+    in a new virtualenv.
+
+    """
+
+
+class BuildTimeout(BuildAborted):
+    """Raised when a build subprocess exceeds the timeout of its phase."""
+
+
+class BuildCancelled(BuildAborted):
+    """Raised when a build is cancelled."""
+
+
+def limit_process(rlimits):
+    """Makes the current process the leader of a new process group, and
+    sets its resource limits.  It's called in build subprocesses before
+    they execute commands.
+
+    """
+    os.setsid()
+    for name, value in rlimits:
+        _, hard = resource.getrlimit(name)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(name, (value, value))
+
+
+def kill_group(pid, signum):
+    """Sends the signal to the process group led by ``pid``.  It does
+    nothing if the group has already gone.
+
+    """
+    try:
+        os.killpg(pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class Sandbox(object):
+    """Limits of subprocesses of a build.
+
+    :param config: the config dictionary
+    :param cancelled: the function which tests whether the build has been
+                      cancelled
+
+    """
+
+    def __init__(self, config=None, cancelled=None):
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.rlimits = []
+        if config is not None:
+            self.timeouts.update(config.get('BUILD_TIMEOUTS', {}))
+            for key, name in RLIMIT_CONFIGS:
+                if config.get(key) is not None and resource is not None:
+                    self.rlimits.append((getattr(resource, name),
+                                         int(config[key])))
+        self.cancelled = cancelled
+
+    def check(self):
+        """Raises :exc:`BuildCancelled` if the build has been cancelled."""
+        if self.cancelled is not None and self.cancelled():
+            raise BuildCancelled('the build has been cancelled')
+
+    def get_popen_options(self):
+        """The keyword arguments to :class:`subprocess.Popen` which
+        apply limits to the subprocess.
+
+        """
+        if os.name != 'posix':
+            return {}
+        return {'preexec_fn': functools.partial(limit_process, self.rlimits)}
+
+    @contextlib.contextmanager
+    def watch(self, process, phase=None):
+        """Kills the process group of the ``process`` if it exceeds
+        the timeout of the ``phase`` or the build is cancelled while
+        the context is active.  Processes left in the group are killed
+        when the context exits.
+
+        :raises BuildTimeout: when the process has been killed because
+                              of the timeout
+        :raises BuildCancelled: when the process has been killed because
+                                the build is cancelled
+
+        """
+        if os.name != 'posix':
+            yield
+            return
+        timeout = self.timeouts.get(phase)
+        state = {}
+        watcher = spawn(self._watch, process, timeout, state)
+        try:
+            yield
+        finally:
+            watcher.kill()
+            kill_group(process.pid, signal.SIGKILL)
+        if state.get('reason') == 'timeout':
+            raise BuildTimeout('the {0} phase exceeded its timeout of {1} '
+                               'seconds'.format(phase, timeout))
+        elif state.get('reason') == 'cancelled':
+            raise BuildCancelled('the build has been cancelled')
+
+    def _watch(self, process, timeout, state):
+        started_at = time.time()
+        while 1:
+            sleep(WATCH_INTERVAL)
+            if timeout is not None and time.time() - started_at > timeout:
+                state['reason'] = 'timeout'
+            elif self.cancelled is not None and self.cancelled():
+                state['reason'] = 'cancelled'
+            else:
+                continue
+            kill_group(process.pid, signal.SIGTERM)
+            sleep(KILL_GRACE_PERIOD)
+            kill_group(process.pid, signal.SIGKILL)
+            return
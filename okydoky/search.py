@@ -0,0 +1,290 @@
+""":mod:`okydoky.search` --- Server-side full-text search
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+When docs are published, the text of their pages is indexed into the SQLite
+database ``search.db`` in ``SAVE_DIRECTORY`` (or ``INDEX_DIRECTORY``), so
+that ``/<ref>/_search?q=`` answers queries without downloading the whole
+``searchindex.js``.
+
+The posting list of each term, i.e., the list of pages which contain the
+term with their term frequencies, is stored once by its digest.  Most terms
+have the same posting lists in consecutive builds, so they're shared across
+builds.
+
+"""
+import contextlib
+import hashlib
+import htmlentitydefs
+import HTMLParser
+import logging
+import math
+import os
+import os.path
+import re
+import sqlite3
+import zlib
+
+from flask import json
+
+from .buildindex import get_index_dir
+
+
+#: (:class:`str`) The filename of the database under ``SAVE_DIRECTORY``.
+SEARCH_FILENAME = 'search.db'
+
+#: (:class:`frozenset`) The pages which aren't indexed.
+EXCLUDED_PAGES = frozenset(['genindex.html', 'search.html',
+                            'py-modindex.html'])
+
+#: (:class:`int`) How many times terms in titles are counted.
+TITLE_WEIGHT = 3
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS postings (
+        digest TEXT PRIMARY KEY,
+        data BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS terms (
+        sha TEXT NOT NULL,
+        term TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (sha, term)
+    );
+    CREATE TABLE IF NOT EXISTS pages (
+        sha TEXT NOT NULL,
+        path TEXT NOT NULL,
+        title TEXT NOT NULL,
+        PRIMARY KEY (sha, path)
+    );
+'''
+
+TERM_PATTERN = re.compile(r'\w{2,64}', re.UNICODE)
+
+
+def tokenize(text):
+    return [term.lower() for term in TERM_PATTERN.findall(text)]
+
+
+class TextExtractor(HTMLParser.HTMLParser):
+    """Extracts the title and the text of the body of a Sphinx page.
+    If there's no ``<div class="body">``, the text of the whole page is
+    taken instead.
+
+    """
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.title = []
+        self.text = []
+        self.body = []
+        self.stack = []
+        self.body_depth = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('br', 'hr', 'img', 'input', 'link', 'meta'):
+            return
+        self.stack.append(tag)
+        if (tag == 'div' and self.body_depth is None and
+                'body' in (dict(attrs).get('class') or '').split()):
+            self.body_depth = len(self.stack)
+
+    def handle_endtag(self, tag):
+        if tag not in self.stack:
+            return
+        while self.stack.pop() != tag:
+            pass
+        if self.body_depth is not None and len(self.stack) < self.body_depth:
+            self.body_depth = -1
+
+    def handle_data(self, data):
+        if 'script' in self.stack or 'style' in self.stack:
+            return
+        elif 'title' in self.stack:
+            self.title.append(data)
+            return
+        self.text.append(data)
+        if self.body_depth > 0:
+            self.body.append(data)
+
+    def handle_entityref(self, name):
+        try:
+            self.handle_data(unichr(htmlentitydefs.name2codepoint[name]))
+        except KeyError:
+            pass
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in ('x', 'X'):
+                codepoint = int(name[1:], 16)
+            else:
+                codepoint = int(name)
+            self.handle_data(unichr(codepoint))
+        except (ValueError, OverflowError):
+            pass
+
+    def get_title(self):
+        return u' '.join(u''.join(self.title).split())
+
+    def get_text(self):
+        return u' '.join(self.body or self.text)
+
+
+def extract_text(filename):
+    """Extracts the title and the text of the HTML page ``filename``."""
+    with open(filename, 'rb') as f:
+        html = f.read().decode('utf-8', 'replace')
+    extractor = TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.get_title(), extractor.get_text()
+
+
+def find_pages(build):
+    """Finds HTML pages to index in the built docs ``build``.  Directories
+    which start with ``_`` e.g. ``_static`` and ``_modules`` are skipped.
+
+    """
+    for dirpath, dirnames, filenames in os.walk(build):
+        dirnames[:] = [d for d in dirnames if not d.startswith('_')]
+        for filename in filenames:
+            fullname = os.path.join(dirpath, filename)
+            path = os.path.relpath(fullname, build).replace(os.sep, '/')
+            if filename.endswith('.html') and path not in EXCLUDED_PAGES:
+                yield path, fullname
+
+
+class SearchIndex(object):
+    """The full-text search index of builds in the ``SAVE_DIRECTORY``.
+
+    :param config: the config dictionary
+
+    """
+
+    def __init__(self, config):
+        index_dir = get_index_dir(config)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self.path = os.path.join(index_dir, SEARCH_FILENAME)
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, sha, build):
+        """Indexes pages of the built docs ``build`` as the build of
+        ``sha``.
+
+        """
+        logger = logging.getLogger(__name__ + '.SearchIndex.add')
+        sha = sha.lower()
+        pages = []
+        postings = {}
+        for path, fullname in find_pages(build):
+            try:
+                title, text = extract_text(fullname)
+            except HTMLParser.HTMLParseError:
+                logger.warning('failed to parse %s', fullname, exc_info=1)
+                continue
+            pages.append((sha, path, title or path))
+            frequencies = {}
+            for term in tokenize(title) * TITLE_WEIGHT + tokenize(text):
+                frequencies[term] = frequencies.get(term, 0) + 1
+            for term, frequency in frequencies.iteritems():
+                postings.setdefault(term, []).append([path, frequency])
+        terms = []
+        blobs = []
+        for term, posting in postings.iteritems():
+            posting.sort()
+            data = json.dumps(posting)
+            digest = hashlib.sha1(data).hexdigest()
+            terms.append((sha, term, digest))
+            blobs.append((digest, sqlite3.Binary(zlib.compress(data))))
+        with self.connect() as db:
+            db.execute('DELETE FROM terms WHERE sha = ?', (sha,))
+            db.execute('DELETE FROM pages WHERE sha = ?', (sha,))
+            db.executemany('INSERT OR IGNORE INTO postings VALUES (?, ?)',
+                           blobs)
+            db.executemany('INSERT INTO terms VALUES (?, ?, ?)', terms)
+            db.executemany('INSERT INTO pages VALUES (?, ?, ?)', pages)
+        logger.info('indexed %d pages and %d terms of %s',
+                    len(pages), len(terms), sha)
+
+    def is_indexed(self, sha):
+        """Whether the build of ``sha`` has been indexed."""
+        with self.connect() as db:
+            row = db.execute('SELECT 1 FROM pages WHERE sha = ? LIMIT 1',
+                             (sha.lower(),)).fetchone()
+        return row is not None
+
+    def search(self, sha, query, limit=20):
+        """Searches pages of the build of ``sha`` which contain all terms
+        of the ``query``.  Pages are ranked by TF-IDF.
+
+        :returns: the list of dictionaries which contain ``'path'``,
+                  ``'title'`` and ``'score'``, the most relevant first
+        :rtype: :class:`list`
+
+        """
+        sha = sha.lower()
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self.connect() as db:
+            titles = dict(db.execute('SELECT path, title FROM pages '
+                                     'WHERE sha = ?', (sha,)))
+            scores = None
+            for term in terms:
+                row = db.execute('SELECT data FROM terms JOIN postings '
+                                 'USING (digest) '
+                                 'WHERE sha = ? AND term = ?',
+                                 (sha, term)).fetchone()
+                if row is None:
+                    return []
+                posting = json.loads(zlib.decompress(str(row[0])))
+                idf = math.log(1 + float(len(titles)) / len(posting))
+                term_scores = dict((path, frequency * idf)
+                                   for path, frequency in posting)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = dict((path, score + term_scores[path])
+                                  for path, score in scores.iteritems()
+                                  if path in term_scores)
+        ranked = sorted(scores.iteritems(), key=lambda item: -item[1])[:limit]
+        return [{'path': path, 'title': titles.get(path, path),
+                 'score': score}
+                for path, score in ranked]
+
+    def copy(self, source, sha):
+        """Indexes the build of ``sha`` as the same as the already
+        indexed build of ``source``.  Posting lists are shared.
+
+        """
+        source = source.lower()
+        sha = sha.lower()
+        with self.connect() as db:
+            db.execute('DELETE FROM terms WHERE sha = ?', (sha,))
+            db.execute('DELETE FROM pages WHERE sha = ?', (sha,))
+            db.execute('INSERT INTO terms SELECT ?, term, digest FROM terms '
+                       'WHERE sha = ?', (sha, source))
+            db.execute('INSERT INTO pages SELECT ?, path, title FROM pages '
+                       'WHERE sha = ?', (sha, source))
+
+    def remove(self, sha):
+        """Removes the build of ``sha`` from the index."""
+        with self.connect() as db:
+            db.execute('DELETE FROM terms WHERE sha = ?', (sha.lower(),))
+            db.execute('DELETE FROM pages WHERE sha = ?', (sha.lower(),))
+
+    def collect_garbage(self):
+        """Removes posting lists which no build refers to anymore."""
+        with self.connect() as db:
+            db.execute('DELETE FROM postings WHERE digest NOT IN '
+                       '(SELECT digest FROM terms)')
@@ -0,0 +1,330 @@
+""":mod:`okydoky.store` --- Deduplicated storage of built docs
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Consecutive builds are mostly identical, so every file of built docs is
+stored once in the ``_objects`` directory under ``SAVE_DIRECTORY``, named by
+the SHA-1 digest of its content, and hard-linked into the directory of each
+commit.  The layout of commit directories doesn't change, so they can be
+served as they are.
+
+The digests of files of each commit are written into its manifest in
+the ``_manifests`` directory, so that they can be served with ETags.
+
+"""
+import errno
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from flask import json
+
+from .incremental import file_digest
+from .pack import PACK_SUFFIX, pack_build
+
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores objects.
+OBJECTS_DIRNAME = '_objects'
+
+#: (:class:`str`) The name of the directory under ``SAVE_DIRECTORY``
+#: which stores manifests of published docs.
+MANIFESTS_DIRNAME = '_manifests'
+
+#: (:class:`int`) The seconds unlinked objects are kept for.
+OBJECT_GRACE_PERIOD = 60 * 60
+
+
+def get_object_path(digest, config):
+    return os.path.join(config['SAVE_DIRECTORY'], OBJECTS_DIRNAME,
+                        digest[:2], digest[2:])
+
+
+def store_file(filename, target, config):
+    """Stores the file ``filename`` into the object store, and links it to
+    ``target``.  The original file is removed.
+
+    :returns: a pair of the digest of the file and whether the same
+              content was already stored
+    :rtype: :class:`tuple`
+
+    """
+    digest = file_digest(filename)
+    obj = get_object_path(digest, config)
+    if os.path.isfile(obj):
+        try:
+            link_file(obj, target)
+        except (IOError, OSError) as e:
+            # The object could be removed by collect_garbage() meanwhile.
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            os.unlink(filename)
+            return digest, True
+    objdir = os.path.dirname(obj)
+    if not os.path.isdir(objdir):
+        try:
+            os.makedirs(objdir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    # Touch the file so that collect_garbage() doesn't remove the object
+    # before it's linked.
+    os.utime(filename, None)
+    os.rename(filename, obj)
+    link_file(obj, target)
+    return digest, False
+
+
+def link_file(obj, target):
+    try:
+        os.link(obj, target)
+    except (AttributeError, OSError) as e:
+        # os.link() is unavailable on Windows, and it fails when links
+        # exceed the maximum number.
+        if getattr(e, 'errno', None) == errno.ENOENT:
+            raise
+        shutil.copy2(obj, target)
+
+
+def publish(build, result_dir, config):
+    """Moves the built docs ``build`` to ``result_dir``.  Unless
+    ``DEDUPLICATE_BUILDS`` is turned off, files are deduplicated through
+    the object store.  The manifest of digests of files is written as well.
+    If ``STORAGE_FORMAT`` is ``'pack'``, the docs are packed into the single
+    file ``result_dir + '.pack'`` instead.
+
+    :returns: a pair of the total size of the docs and the number of bytes
+              saved by deduplication
+    :rtype: :class:`tuple`
+
+    """
+    logger = logging.getLogger(__name__ + '.publish')
+    if config.get('STORAGE_FORMAT', 'directory') == 'pack':
+        size = pack_build(build, result_dir + PACK_SUFFIX)
+        shutil.rmtree(build)
+        logger.info('packed %s: %d bytes', result_dir + PACK_SUFFIX, size)
+        return size, 0
+    elif not config.get('DEDUPLICATE_BUILDS', True):
+        shutil.move(build, result_dir)
+        write_manifest(result_dir, make_manifest(result_dir), config)
+        return get_size(result_dir), 0
+    parent = os.path.dirname(result_dir)
+    tmp = tempfile.mkdtemp(prefix='.' + os.path.basename(result_dir),
+                           dir=parent)
+    total = saved = 0
+    manifest = {}
+    try:
+        for dirpath, dirnames, filenames in os.walk(build):
+            target_dir = os.path.join(tmp, os.path.relpath(dirpath, build))
+            for dirname in dirnames:
+                if os.path.islink(os.path.join(dirpath, dirname)):
+                    filenames.append(dirname)
+                else:
+                    os.mkdir(os.path.join(target_dir, dirname))
+            for filename in filenames:
+                fullname = os.path.join(dirpath, filename)
+                target = os.path.join(target_dir, filename)
+                if os.path.islink(fullname) or not os.path.isfile(fullname):
+                    os.rename(fullname, target)
+                    continue
+                size = os.path.getsize(fullname)
+                total += size
+                digest, stored = store_file(fullname, target, config)
+                manifest[os.path.relpath(target, tmp)] = digest
+                if stored:
+                    saved += size
+        os.chmod(tmp, 0755)
+        write_manifest(result_dir, manifest, config)
+        os.rename(tmp, result_dir)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    shutil.rmtree(build)
+    logger.info('published %s: %d bytes, %d bytes (%.1f%%) saved by '
+                'deduplication', result_dir, total, saved,
+                total and saved * 100.0 / total)
+    return total, saved
+
+
+def clone(source, result_dir, config):
+    """Publishes the docs already published as ``source`` to ``result_dir``
+    as well, without building them again.  Files are hard-linked, so it
+    takes no extra space.  The manifest is copied as well.
+
+    :returns: the total size of the docs
+    :rtype: :class:`int`
+
+    """
+    logger = logging.getLogger(__name__ + '.clone')
+    if os.path.isfile(source + PACK_SUFFIX):
+        link_file(source + PACK_SUFFIX, result_dir + PACK_SUFFIX)
+        size = os.path.getsize(result_dir + PACK_SUFFIX)
+    else:
+        parent = os.path.dirname(result_dir)
+        tmp = tempfile.mkdtemp(prefix='.' + os.path.basename(result_dir),
+                               dir=parent)
+        size = 0
+        try:
+            for dirpath, dirnames, filenames in os.walk(source):
+                relpath = os.path.relpath(dirpath, source)
+                target_dir = os.path.join(tmp, relpath)
+                for dirname in dirnames:
+                    if os.path.islink(os.path.join(dirpath, dirname)):
+                        filenames.append(dirname)
+                    else:
+                        os.mkdir(os.path.join(target_dir, dirname))
+                for filename in filenames:
+                    fullname = os.path.join(dirpath, filename)
+                    target = os.path.join(target_dir, filename)
+                    if os.path.islink(fullname):
+                        os.symlink(os.readlink(fullname), target)
+                    else:
+                        link_file(fullname, target)
+                        size += os.path.getsize(fullname)
+            os.chmod(tmp, 0755)
+            os.rename(tmp, result_dir)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    manifest = read_manifest(source, config)
+    if manifest is not None:
+        write_manifest(result_dir, manifest, config)
+    logger.info('cloned %s to %s: %d bytes', source, result_dir, size)
+    return size
+
+
+def unpublish(result_dir, config, grace_period=OBJECT_GRACE_PERIOD):
+    """Removes the published docs of ``result_dir`` in any format, and its
+    manifest.  Objects of the docs which aren't linked anymore are removed
+    as well, except ones modified within ``grace_period`` seconds, which
+    are left to :func:`collect_garbage()`.
+
+    :returns: the number of bytes freed, including objects left to
+              :func:`collect_garbage()`
+    :rtype: :class:`int`
+
+    """
+    manifest = read_manifest(result_dir, config) or {}
+    freed = 0
+    if os.path.isdir(result_dir):
+        for dirpath, _, filenames in os.walk(result_dir):
+            for filename in filenames:
+                stat = os.lstat(os.path.join(dirpath, filename))
+                if stat.st_nlink == 1:
+                    freed += stat.st_size
+        shutil.rmtree(result_dir)
+    for filename in (result_dir + PACK_SUFFIX,
+                     get_manifest_path(result_dir, config)):
+        try:
+            stat = os.lstat(filename)
+            os.unlink(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if stat.st_nlink == 1:
+                freed += stat.st_size
+    deadline = time.time() - grace_period
+    for digest in set(manifest.values()):
+        obj = get_object_path(digest, config)
+        try:
+            stat = os.lstat(obj)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        if stat.st_nlink == 1:
+            freed += stat.st_size
+            if stat.st_mtime < deadline:
+                os.unlink(obj)
+    return freed
+
+
+def collect_garbage(config, grace_period=OBJECT_GRACE_PERIOD):
+    """Removes objects which no published docs link to anymore.  Objects
+    modified within ``grace_period`` seconds are kept, since they may be
+    about to be linked.
+
+    :returns: a pair of the number of removed objects and their total size
+    :rtype: :class:`tuple`
+
+    """
+    logger = logging.getLogger(__name__ + '.collect_garbage')
+    root = os.path.join(config['SAVE_DIRECTORY'], OBJECTS_DIRNAME)
+    deadline = time.time() - grace_period
+    count = size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            obj = os.path.join(dirpath, filename)
+            stat = os.lstat(obj)
+            if stat.st_nlink == 1 and stat.st_mtime < deadline:
+                os.unlink(obj)
+                count += 1
+                size += stat.st_size
+    logger.info('removed %d unlinked objects (%d bytes) in %s',
+                count, size, root)
+    return count, size
+
+
+def is_published(result_dir):
+    """Whether the docs of ``result_dir`` are published in any format."""
+    return (os.path.isdir(result_dir) or
+            os.path.isfile(result_dir + PACK_SUFFIX))
+
+
+def get_size(path):
+    """Sums sizes of all files in ``path``."""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            fullname = os.path.join(dirpath, filename)
+            if not os.path.islink(fullname):
+                total += os.path.getsize(fullname)
+    return total
+
+
+def make_manifest(path):
+    """Makes the manifest of files in ``path``, a dictionary of relative
+    paths to their SHA-1 digests.
+
+    """
+    manifest = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            fullname = os.path.join(dirpath, filename)
+            if not os.path.islink(fullname):
+                relpath = os.path.relpath(fullname, path)
+                manifest[relpath] = file_digest(fullname)
+    return manifest
+
+
+def get_manifest_path(result_dir, config):
+    return os.path.join(config['SAVE_DIRECTORY'], MANIFESTS_DIRNAME,
+                        os.path.basename(result_dir) + '.json')
+
+
+def write_manifest(result_dir, manifest, config):
+    filename = get_manifest_path(result_dir, config)
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(prefix='.', dir=dirname)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp, filename)
+
+
+def read_manifest(result_dir, config):
+    """Reads the manifest of the published docs ``result_dir``.  Returns
+    ``None`` if there's no manifest, e.g., it was published by an older
+    version of Okydoky.
+
+    """
+    try:
+        with open(get_manifest_path(result_dir, config)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
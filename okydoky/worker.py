@@ -0,0 +1,65 @@
+""":mod:`okydoky.worker` --- Build worker
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+The build worker runs builds queued by the web server in a separate
+process, so that builds never block serving docs.  The ``okydoky`` script
+runs it by default.  It can be run separately as well:
+
+.. code-block:: console
+
+   $ okydoky --no-worker yourconfig.py
+   $ okydoky-worker yourconfig.py
+
+"""
+from __future__ import absolute_import
+
+import logging
+import optparse
+import os
+
+from eventlet import sleep, spawn_n
+from eventlet.event import Event
+
+from .app import app, start_workers
+from .cluster import get_node_name
+from .metrics import SNAPSHOT_INTERVAL, write_snapshot
+from .run import configure
+
+
+parser = optparse.OptionParser(usage='%prog [options] config')
+parser.add_option('-d', '--debug', action='store_true',
+                  help='debug mode')
+parser.add_option('-q', '--quiet', action='store_const', const=logging.ERROR,
+                  dest='verbosity', help='suppress output')
+parser.add_option('-v', '--verbose', action='store_const', const=logging.INFO,
+                  dest='verbosity', help='enable additional output')
+parser.add_option('--noisy', action='store_const', const=logging.DEBUG,
+                  dest='verbosity', help='be noisy')
+
+
+def write_metrics(config):
+    """Writes the snapshot of metrics every
+    :const:`~okydoky.metrics.SNAPSHOT_INTERVAL` seconds, so that the web
+    server can expose them.
+
+    """
+    logger = logging.getLogger(__name__ + '.write_metrics')
+    worker = '{0}-{1}'.format(get_node_name(config), os.getpid())
+    while 1:
+        try:
+            write_snapshot(config, worker)
+        except EnvironmentError:
+            logger.exception('failed to write the snapshot of metrics')
+        sleep(SNAPSHOT_INTERVAL)
+
+
+def main(*args, **kwargs):
+    options, args = parser.parse_args(*args, **kwargs)
+    configure(parser, options, args)
+    start_workers(app.config)
+    spawn_n(write_metrics, app.config)
+    Event().wait()
+
+
+if __name__ == '__main__':
+    main()
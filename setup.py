@@ -44,7 +44,8 @@ setup(
     install_requires=requirements,
     entry_points = {
         'console_scripts': [
-            'okydoky = okydoky.run:main'
+            'okydoky = okydoky.run:main',
+            'okydoky-worker = okydoky.worker:main'
         ]
     },
     classifiers=[
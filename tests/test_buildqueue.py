@@ -0,0 +1,129 @@
+"""Tests of :class:`okydoky.buildqueue.BuildQueue` shared by several
+processes, as build workers on several nodes share a ``SAVE_DIRECTORY``.
+
+.. code-block:: console
+
+   $ python -m unittest discover tests
+
+"""
+import multiprocessing
+import os
+import os.path
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from okydoky.buildqueue import LEASE_TIMEOUT, BuildQueue
+
+
+#: (:class:`int`) The number of worker processes.
+PROCESSES = 4
+
+#: (:class:`int`) The number of jobs to claim.
+JOBS = 200
+
+
+def claim_all(save_dir, results):
+    """Claims jobs until the queue is empty, and puts the claimed commits
+    into ``results``.
+
+    """
+    queue = BuildQueue({'SAVE_DIRECTORY': save_dir})
+    claimed = []
+    while 1:
+        job = queue.claim()
+        if job is None:
+            break
+        claimed.append(job['commit'])
+        queue.complete(job)
+    results.put(claimed)
+
+
+def claim_and_hang(save_dir, claimed):
+    """Claims a job and never completes it, as a worker which dies in
+    the middle of a build.
+
+    """
+    queue = BuildQueue({'SAVE_DIRECTORY': save_dir})
+    job = queue.claim()
+    claimed.put(job['commit'])
+    while 1:
+        time.sleep(1)
+
+
+class BuildQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.save_dir = tempfile.mkdtemp(prefix='okydoky-test-')
+        self.config = {'SAVE_DIRECTORY': self.save_dir}
+
+    def tearDown(self):
+        shutil.rmtree(self.save_dir)
+
+    def push(self, count):
+        commits = ['{0:040x}'.format(i) for i in xrange(count)]
+        BuildQueue(self.config).push([(commit, 'http://example.com/')
+                                      for commit in commits])
+        return commits
+
+    def test_claimed_exactly_once(self):
+        commits = self.push(JOBS)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=claim_all,
+                                             args=(self.save_dir, results))
+                     for _ in xrange(PROCESSES)]
+        for process in processes:
+            process.start()
+        claimed = []
+        for _ in processes:
+            claimed.extend(results.get(timeout=60))
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(sorted(claimed), sorted(commits))
+        self.assertEqual(len(claimed), len(set(claimed)))
+        queue = BuildQueue(self.config)
+        self.assertEqual(queue.pending(), [])
+        self.assertEqual(queue.running(), [])
+
+    def start_claimer(self):
+        claimed = multiprocessing.Queue()
+        process = multiprocessing.Process(target=claim_and_hang,
+                                          args=(self.save_dir, claimed))
+        process.start()
+        commit = claimed.get(timeout=60)
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        return commit
+
+    def test_killed_claimer_recovered(self):
+        self.push(1)
+        commit = self.start_claimer()
+        queue = BuildQueue(self.config)
+        self.assertTrue(queue.is_running(commit))
+        self.assertEqual(queue.claim(), None)
+        # The dead process was on the same node, so its lease expires
+        # immediately.
+        self.assertEqual(queue.recover(), 1)
+        job = queue.claim()
+        self.assertEqual(job['commit'], commit)
+        self.assertEqual(job['owner'], queue.owner)
+
+    def test_killed_claimer_on_other_node_recovered(self):
+        self.push(1)
+        commit = self.start_claimer()
+        queue = BuildQueue(dict(self.config, NODE_NAME='other-node'))
+        # Processes of other nodes can't be checked, so the lease expires
+        # only after it hasn't been renewed for LEASE_TIMEOUT.
+        self.assertEqual(queue.recover(), 0)
+        renewed_at = time.time() - LEASE_TIMEOUT - 1
+        os.utime(os.path.join(queue.path, commit + '.running'),
+                 (renewed_at, renewed_at))
+        self.assertEqual(queue.recover(), 1)
+        self.assertEqual(queue.claim()['commit'], commit)
+
+
+if __name__ == '__main__':
+    unittest.main()